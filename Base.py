@@ -1,146 +1,902 @@
 import os
+import sys
+import time
+import pickle
+import datetime
+import itertools
 import logging
 import logging.config
 import configparser
-from typing import List, Tuple, Dict, Type, Optional, Iterable, Set
-from threading import RLock
+from typing import List, Tuple, Dict, Type, Optional, Iterable, Iterator, Set, Deque, TYPE_CHECKING
+from threading import RLock, Lock, Condition, Thread, Event
+from collections import deque, OrderedDict
 
-from sqlalchemy.orm import DeclarativeBase, sessionmaker, mapped_column, Mapped
-from sqlalchemy import create_engine, Sequence, URL, event, text, Integer, select, Column, inspect
+from sqlalchemy.orm import DeclarativeBase, sessionmaker, mapped_column, Mapped, Session as SessionType
+from sqlalchemy import create_engine, make_url, Engine, Sequence, URL, event, UniqueConstraint, PrimaryKeyConstraint, text, Integer, select, func, Column, inspect, Table, MetaData, Date, DateTime, Connection, and_, true
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import StaticPool
+
+from Metrics import metrics, MetricsServer, Sample
+
+if TYPE_CHECKING:
+    # numpy and pandas are imported where the column data is built, importing Base stays cheap for every module
+    import numpy as np
+    import pandas as pd
 
 WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
 
 config = configparser.ConfigParser()
 config.read(WORKING_DIR+os.sep+'config.properties')
 
-API_KEY = config.get("api", "api_key")
-
-logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
 logger = logging.getLogger('DB')
 
+def configure_logging(path: str = WORKING_DIR+os.sep+'logging.conf') -> None:
+    # Entry points call this; loggers created at import time stay enabled
+    logging.config.fileConfig(path, disable_existing_loggers=False)
 
-db_host=config.get("db", "db_host")
-db_name=config.get("db", "db_name")
-db_user=config.get("db", "user")
-db_password=config.get("db", "password")
-
-sqlalchemy_url = URL.create(
-    "mysql+mysqldb",
-    username=db_user,
-    password=db_password,
-    host=db_host,
-    database=db_name,
-)
+def get_api_key() -> str:
+    return config.get("api", "api_key")
 
 class Base(DeclarativeBase):
     pass
 
-engine = create_engine(sqlalchemy_url, pool_pre_ping=True, isolation_level="READ COMMITTED")
-#engine = create_engine(sqlalchemy_url, pool_pre_ping=True, echo=True, isolation_level="READ COMMITTED")
+_engine: Optional[Engine] = None
+_engine_lock = Lock()
+
+def _create_mysql_engine(sqlalchemy_url: Optional[URL] = None) -> Engine:
+    # MariaDB/MySQL from the [db] host settings or a [db] url; both get the same sql_mode and isolation level
+    if sqlalchemy_url is None:
+        sqlalchemy_url = URL.create(
+            "mysql+mysqldb",
+            username=config.get("db", "user"),
+            password=config.get("db", "password"),
+            host=config.get("db", "db_host"),
+            database=config.get("db", "db_name"),
+        )
+    engine = create_engine(sqlalchemy_url, pool_pre_ping=True, isolation_level="READ COMMITTED")
+    #engine = create_engine(sqlalchemy_url, pool_pre_ping=True, echo=True, isolation_level="READ COMMITTED")
+
+    @event.listens_for(engine, "connect", insert=True)
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SET sql_mode = 'TRADITIONAL,NO_ENGINE_SUBSTITUTION'")
+
+    return engine
+
+def _sqlite_collate(a: str, b: str) -> int:
+    a, b = a.casefold(), b.casefold()
+    return (a > b) - (a < b)
+
+def _sqlite_concat(*values) -> str:
+    return ''.join('' if value is None else str(value) for value in values)
+
+def _create_sqlite_engine(sqlalchemy_url: URL) -> Engine:
+    # In-memory databases live on one shared connection and suit single threaded runs;
+    # file databases use WAL so the threaded pipelines can read while one writer commits
+    in_memory = sqlalchemy_url.database in (None, '', ':memory:')
+    if in_memory:
+        engine = create_engine(sqlalchemy_url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    else:
+        engine = create_engine(sqlalchemy_url, connect_args={"check_same_thread": False, "timeout": 30})
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        # Stand-ins for the MySQL collation and concat() used by the models
+        dbapi_connection.create_collation('utf8mb4_unicode_520_ci', _sqlite_collate)
+        dbapi_connection.create_function('concat', -1, _sqlite_concat, deterministic=True)
+        cursor = dbapi_connection.cursor()
+        if not in_memory:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    return engine
+
+def get_engine() -> Engine:
+    # The engine is created on first use, so importing the models does not need a reachable database.
+    # [db] url selects another backend, e.g. sqlite:///marketdata.db or sqlite:// for in-memory. Only MariaDB/MySQL
+    # and SQLite are supported, the id sequence and upserts have no implementation for other dialects
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            url = config.get("db", "url", fallback=None)
+            if url:
+                sqlalchemy_url = make_url(url)
+                dialect = sqlalchemy_url.get_dialect().name
+                if dialect == 'sqlite':
+                    engine = _create_sqlite_engine(sqlalchemy_url)
+                elif dialect in ('mysql', 'mariadb'):
+                    engine = _create_mysql_engine(sqlalchemy_url)
+                else:
+                    raise ValueError(f"Unsupported [db] url dialect {dialect}, use a mysql, mariadb or sqlite url")
+            else:
+                engine = _create_mysql_engine()
+            Session.configure(bind=engine)
+            _engine = engine
+        return _engine
+
+def is_sqlite() -> bool:
+    return get_engine().dialect.name == 'sqlite'
+
+def __getattr__(name: str):
+    # Keeps `Base.engine` and `Base.API_KEY` working without creating them at import
+    if name == 'engine':
+        return get_engine()
+    if name == 'API_KEY':
+        return get_api_key()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class _LazySessionmaker(sessionmaker):
+    def __call__(self, **local_kw):
+        if self.kw.get('bind') is None:
+            get_engine()
+        return super().__call__(**local_kw)
+
+Session = _LazySessionmaker(autoflush=False, expire_on_commit=False)
+
+# ORM flush and commit latency; db_commit_seconds includes the flush that commit() triggers
+@event.listens_for(Session, "before_flush")
+def _before_flush(session: SessionType, flush_context, instances) -> None:
+    session.info['flush_start'] = time.perf_counter()
 
-@event.listens_for(engine, "connect", insert=True)
-def connect(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("SET sql_mode = 'TRADITIONAL,NO_ENGINE_SUBSTITUTION'")
+@event.listens_for(Session, "after_flush_postexec")
+def _after_flush(session: SessionType, flush_context) -> None:
+    start = session.info.pop('flush_start', None)
+    if start is not None:
+        metrics.observe('db_flush_seconds', time.perf_counter() - start)
 
-Session = sessionmaker(engine, autoflush=False, expire_on_commit=False)
+@event.listens_for(Session, "before_commit")
+def _before_commit(session: SessionType) -> None:
+    session.info['commit_start'] = time.perf_counter()
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session: SessionType) -> None:
+    start = session.info.pop('commit_start', None)
+    if start is not None:
+        metrics.observe('db_commit_seconds', time.perf_counter() - start)
 
 id_seq = Sequence("id_seq",metadata=Base.metadata, start=1, increment=1000, cache=10)
 
-_id_pool = []
+ID_PREFETCH_THRESHOLD: int = config.getint("db", "id_prefetch_threshold", fallback=250)
 
-def get_next_id() -> int:
-    if(len(_id_pool) == 0):
-        logger.info("id pool empty, querying for more")
-        fill_pool()
-    return _id_pool.pop(0)
-    
-def get_ids(nIds: int) -> List[int]:
-    while len(_id_pool)<nIds:
-        fill_pool()
-    ret_ids = _id_pool[0:nIds]
-    del _id_pool[0:nIds]
-    return ret_ids
-    
-""" def fill_pool() -> None:
-    #conn = cls.getConnection()
-    #res = conn.executeQuery("SELECT NEXTVAL(id_seq),increment from id_seq")
-    with Session() as session:
-        res = session.execute(text("SELECT NEXTVAL(id_seq),increment from id_seq")).first()
-        #res = cls.singleQuery("SELECT NEXTVAL(id_seq),increment from id_seq")
-        next_val = res[0]
-        increment = res[1]
-        logger.debug("Adding values %d to %d to id pool"  % (next_val,next_val+increment))
-        _id_pool.extend(range(next_val,next_val+increment)) """
-    
-def fill_pool() -> None:
+_sqlite_id_seq_ready = False
+
+def _fetch_sqlite_id_blocks(count: int) -> List[range]:
+    # SQLite has no sequences, id_seq is emulated by a single row table advanced with UPDATE ... RETURNING
+    global _sqlite_id_seq_ready
+    increment = id_seq.increment * count
+    with get_engine().begin() as conn:
+        if not _sqlite_id_seq_ready:
+            conn.execute(text("CREATE TABLE IF NOT EXISTS id_seq (id INTEGER PRIMARY KEY CHECK (id = 0), next_val INTEGER NOT NULL)"))
+            conn.execute(text("INSERT OR IGNORE INTO id_seq (id, next_val) VALUES (0, :start)"), {'start': id_seq.start})
+            _sqlite_id_seq_ready = True
+        next_val = conn.execute(text("UPDATE id_seq SET next_val = next_val + :increment RETURNING next_val - :increment"),
+                                {'increment': increment}).scalar()
+    logger.debug("Reserved ids %d to %d from id_seq"  % (next_val,next_val+increment))
+    return [range(next_val, next_val+increment)]
+
+def fetch_id_blocks(count: int = 1) -> List[range]:
+    # Each NEXTVAL(id_seq) reserves a block of `increment` ids; adjacent blocks are merged
+    if is_sqlite():
+        return _fetch_sqlite_id_blocks(count)
+    blocks: List[range] = []
     with Session() as session:
-        res = session.execute(text("SELECT NEXTVAL(id_seq),increment from id_seq")).first()
-        if res:
+        for _ in range(count):
+            res = session.execute(text("SELECT NEXTVAL(id_seq),increment from id_seq")).first()
+            if not res:
+                logger.error("Unable to fill id pool from id_seq")
+                raise RuntimeError("Unable to fill id pool from id_seq")
             next_val = res[0]
             increment = res[1]
-            logger.debug("Adding values %d to %d to id pool"  % (next_val,next_val+increment))
-            _id_pool.extend(range(next_val,next_val+increment))
+            logger.debug("Reserved ids %d to %d from id_seq"  % (next_val,next_val+increment))
+            if blocks and blocks[-1].stop == next_val:
+                blocks[-1] = range(blocks[-1].start, next_val+increment)
+            else:
+                blocks.append(range(next_val,next_val+increment))
+    return blocks
+
+class IdAllocator:
+    # Lock protected range allocator over blocks reserved from id_seq.
+    # Ids are handed out from current/end counters; when fewer than `threshold` ids are left
+    # the next block is fetched on a background thread so callers rarely wait on the sequence
+    _lock: Lock
+    _fetched: Condition
+    _blocks: Deque[range]
+    _current: int
+    _end: int
+    _available: int
+    _threshold: int
+    _prefetching: bool
+
+    def __init__(self, threshold: int = ID_PREFETCH_THRESHOLD):
+        self._lock = Lock()
+        self._fetched = Condition(self._lock)
+        self._blocks = deque()
+        self._current = 0
+        self._end = 0
+        self._available = 0
+        self._threshold = threshold
+        self._prefetching = False
+
+    @property
+    def available(self) -> int:
+        return self._available
+
+    def _add_blocks(self, blocks: List[range]) -> None:
+        for block in blocks:
+            self._blocks.append(block)
+            self._available += len(block)
+
+    def _prefetch(self) -> None:
+        try:
+            blocks = fetch_id_blocks()
+        except Exception as ex:
+            logger.error("Background id prefetch failed")
+            logger.error(ex)
+            blocks = []
+        with self._lock:
+            self._add_blocks(blocks)
+            self._prefetching = False
+            self._fetched.notify_all()
+
+    def _maybe_prefetch(self) -> None:
+        if self._available < self._threshold and not self._prefetching:
+            self._prefetching = True
+            Thread(target=self._prefetch, name='IdPrefetch', daemon=True).start()
+
+    def _ensure(self, n: int) -> None:
+        while self._available < n:
+            if self._prefetching:
+                self._fetched.wait()
+                continue
+            missing = n - self._available
+            logger.info("id pool empty, querying for more")
+            self._prefetching = True
+            try:
+                self._lock.release()
+                try:
+                    blocks = fetch_id_blocks(max(1, -(-missing // id_seq.increment)))
+                finally:
+                    self._lock.acquire()
+                self._add_blocks(blocks)
+            finally:
+                self._prefetching = False
+                self._fetched.notify_all()
+
+    def reserve(self, n: int) -> List[range]:
+        # Returns ranges covering exactly n ids, as few and as large as the reserved blocks allow
+        ranges: List[range] = []
+        with self._lock:
+            self._ensure(n)
+            while n > 0:
+                if self._current == self._end:
+                    block = self._blocks.popleft()
+                    self._current = block.start
+                    self._end = block.stop
+                take = min(n, self._end - self._current)
+                ranges.append(range(self._current, self._current + take))
+                self._current += take
+                self._available -= take
+                n -= take
+            self._maybe_prefetch()
+        return ranges
+
+    def next_id(self) -> int:
+        with self._lock:
+            self._ensure(1)
+            if self._current == self._end:
+                block = self._blocks.popleft()
+                self._current = block.start
+                self._end = block.stop
+            id = self._current
+            self._current += 1
+            self._available -= 1
+            self._maybe_prefetch()
+            return id
+
+id_allocator = IdAllocator()
+
+def get_next_id() -> int:
+    return id_allocator.next_id()
+    
+def get_ids(nIds: int) -> List[int]:
+    return [id for id_range in id_allocator.reserve(nIds) for id in id_range]
+
+def get_id_array(nIds: int) -> 'np.ndarray':
+    import numpy as np
+    id_ranges = id_allocator.reserve(nIds)
+    if len(id_ranges) == 1:
+        return np.arange(id_ranges[0].start, id_ranges[0].stop, dtype=np.int64)
+    return np.concatenate([np.arange(id_range.start, id_range.stop, dtype=np.int64) for id_range in id_ranges]) if id_ranges else np.empty(0, dtype=np.int64)
+
+BULK_BATCH_SIZE: int = config.getint("db", "bulk_batch_size", fallback=5000)
+
+ColumnData = Dict[str, 'np.ndarray']
+# Buffered column data and its row count, see BulkWriter.take
+PendingBatch = Tuple[List[ColumnData], int]
+
+def _to_python_column(column: Column, values: 'np.ndarray') -> List:
+    # Converts a numpy column into python values accepted by the DB driver, with nulls as None
+    import numpy as np
+    if values.dtype.kind == 'M':
+        unit = 'datetime64[D]' if isinstance(column.type, Date) and not isinstance(column.type, DateTime) else 'datetime64[us]'
+        return values.astype(unit).tolist()
+    if values.dtype.kind == 'f':
+        mask = np.isnan(values)
+        if isinstance(column.type, Integer):
+            python_values = np.where(mask, 0, values).astype(np.int64).astype(object)
         else:
-            logger.error("Unable to fill id pool from id_seq")
-            raise
+            python_values = values.astype(object)
+        python_values[mask] = None
+        return python_values.tolist()
+    if values.dtype.kind == 'O':
+        import pandas as pd
+        python_values = values.copy()
+        python_values[pd.isna(values)] = None
+        return python_values.tolist()
+    return values.tolist()
+
+class BulkWriter:
+    # Core level INSERT ... ON DUPLICATE KEY UPDATE writer, bypasses the ORM unit of work.
+    # Column data is buffered until batch_size rows are pending and then written as one multi-row insert
+    _table: Table
+    _update_columns: Tuple[str,...]
+    _batch_size: int
+    _auto_flush: bool
+    _pending: List[ColumnData]
+    _pending_rows: int
+    _rows_written: int
+    _write_time: float
+    _lock: RLock
+
+    def __init__(self, table: Table, update_columns: Iterable[str] = (), batch_size: Optional[int] = None, auto_flush: bool = True):
+        self._lock = RLock()
+        self._table = table
+        self._auto_flush = auto_flush
+        self._update_columns = tuple(update_columns)
+        self._batch_size = batch_size if batch_size else BULK_BATCH_SIZE
+        self._pending = []
+        self._pending_rows = 0
+        self._rows_written = 0
+        self._write_time = 0.0
+
+    @property
+    def rows_written(self) -> int:
+        return self._rows_written
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self._rows_written / self._write_time if self._write_time > 0 else 0.0
+
+    def _conflict_columns(self) -> List[str]:
+        # ON DUPLICATE KEY fires on any unique key; SQLite needs the target named, rows collide on the natural key
+        for constraint in self._table.constraints:
+            if isinstance(constraint, UniqueConstraint) and not isinstance(constraint, PrimaryKeyConstraint):
+                return [col.name for col in constraint.columns]
+        return [col.name for col in self._table.primary_key.columns]
+
+    def _statement(self):
+        if is_sqlite():
+            stmt = sqlite_insert(self._table)
+            if self._update_columns:
+                stmt = stmt.on_conflict_do_update(index_elements=self._conflict_columns(),
+                                                  set_={col: stmt.excluded[col] for col in self._update_columns})
+            return stmt
+        stmt = mysql_insert(self._table)
+        if self._update_columns:
+            stmt = stmt.on_duplicate_key_update({col: stmt.inserted[col] for col in self._update_columns})
+        return stmt
+
+    def add(self, df: 'pd.DataFrame') -> None:
+        self.add_columns({col: df[col].to_numpy() for col in df.columns})
+
+    def add_record(self, record: Dict) -> None:
+        import numpy as np
+        self.add_columns({col: np.array([value], dtype=object) for col, value in record.items()})
+
+    def add_columns(self, columns: ColumnData) -> None:
+        rows = len(next(iter(columns.values()))) if columns else 0
+        if rows == 0:
+            return
+        with self._lock:
+            self._pending.append(columns)
+            self._pending_rows += rows
+            if self._auto_flush and self._pending_rows >= self._batch_size:
+                self.flush()
+
+    def _records(self, pending: List[ColumnData]) -> List[Dict]:
+        import numpy as np
+        names = [col.name for col in self._table.columns if col.name in pending[0]]
+        values = [_to_python_column(self._table.columns[name], np.concatenate([columns[name] for columns in pending]))
+                  for name in names]
+        return [dict(zip(names, row)) for row in zip(*values)]
+
+    @property
+    def pending_rows(self) -> int:
+        return self._pending_rows
+
+    def take(self) -> PendingBatch:
+        # Removes the buffered rows for write(); callers owning a wider transaction restore() them if it fails
+        with self._lock:
+            batch = (self._pending, self._pending_rows)
+            self._pending = []
+            self._pending_rows = 0
+            return batch
+
+    def restore(self, batch: PendingBatch) -> None:
+        # Puts a batch whose transaction failed back in front of the rows added since
+        pending, rows = batch
+        with self._lock:
+            self._pending = pending + self._pending
+            self._pending_rows += rows
+
+    def write(self, conn: Connection, batch: PendingBatch) -> int:
+        pending, rows = batch
+        if rows == 0:
+            return 0
+        records = self._records(pending)
+        start = time.perf_counter()
+        conn.execute(self._statement(), records)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._rows_written += len(records)
+            self._write_time += elapsed
+        metrics.observe('db_bulk_write_seconds', elapsed, table=self._table.name)
+        metrics.inc('db_rows_written', len(records), table=self._table.name)
+        logger.debug("Wrote %d rows to %s in %.3f s (%.0f rows/sec)", len(records), self._table.name, elapsed, len(records)/elapsed if elapsed > 0 else 0)
+        return len(records)
+
+    def flush(self, conn: Optional[Connection] = None) -> int:
+        # Writes in its own transaction unless a connection is passed to join the caller's transaction.
+        # A failed write keeps the rows buffered for the next flush
+        with self._lock:
+            if self._pending_rows == 0:
+                return 0
+            batch = self.take()
+            try:
+                if conn is None:
+                    with get_engine().begin() as conn:
+                        return self.write(conn, batch)
+                return self.write(conn, batch)
+            except Exception:
+                self.restore(batch)
+                raise
+
+    def close(self) -> None:
+        self.flush()
+        logger.info("Wrote %d rows to %s at %.0f rows/sec", self._rows_written, self._table.name, self.rows_per_sec)
+
+    def __enter__(self) -> "BulkWriter":
+        return self
 
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+CACHE_MAX_SIZE: int = config.getint("cache", "max_size", fallback=100000)
+CACHE_TTL_SECONDS: float = config.getfloat("cache", "ttl_seconds", fallback=0)
+CACHE_WARM_BATCH_SIZE: int = config.getint("cache", "warm_batch_size", fallback=5000)
+CACHE_SNAPSHOT: bool = config.getboolean("cache", "snapshot", fallback=False)
+CACHE_SNAPSHOT_DIR = WORKING_DIR+os.sep+'stage'
+CACHE_NEGATIVE_MAX_SIZE: int = config.getint("cache", "negative_max_size", fallback=10000)
+CACHE_NEGATIVE_TTL_SECONDS: float = config.getfloat("cache", "negative_ttl_seconds", fallback=60)
+CACHE_COHERENCE_INTERVAL: float = config.getfloat("cache", "coherence_interval", fallback=0)
+CACHE_LOAD_BATCH_SIZE: int = config.getint("cache", "load_batch_size", fallback=1000)
+CACHE_STAGING_THRESHOLD: int = config.getint("cache", "staging_table_threshold", fallback=0)
+
+_caches: List["DBObjectCache"] = []
+
+class _CacheEntry:
+    __slots__ = ('object', 'keys', 'multi_keys', 'expires')
+
+    def __init__(self, object: "CacheableDBObject", keys: Dict[str,str|int], multi_keys: Dict[str,str|int], expires: float):
+        self.object = object
+        self.keys = keys
+        self.multi_keys = multi_keys
+        self.expires = expires
+
+class PendingLoad:
+    # A database load in flight for one cache key, shared by every thread that missed on it
+    __slots__ = ('_done', '_result', '_error')
+
+    def __init__(self):
+        self._done = Event()
+        self._result = None
+        self._error = None
+
+    def resolve(self, result: Optional["CacheableDBObject"]) -> None:
+        if not self._done.is_set():
+            self._result = result
+            self._done.set()
+
+    def fail(self, error: Exception) -> None:
+        if not self._done.is_set():
+            self._error = error
+            self._done.set()
+
+    def wait(self) -> Optional["CacheableDBObject"]:
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
 
 class DBObjectCache:
+    # LRU cache of one CacheableDBObject type, reachable through every cacheable attribute.
+    # Entries are ordered by recency on the object's id, so evicting or invalidating an
+    # object always removes it from all attribute maps together.
+    # Capacity and TTL come from [cache] max_size/ttl_seconds, overridable per type with
+    # <type>_max_size/<type>_ttl_seconds; a capacity or TTL of 0 disables the limit.
+    # Keys the database did not have are remembered in a small bounded negative cache for
+    # negative_ttl_seconds, until an object holding that key is put.
+    # Non-unique attributes are indexed as key -> set of objects; a key is only answered from
+    # the cache once it is complete, i.e. every row holding it was loaded, and stops being
+    # complete as soon as one of its objects leaves the cache
     _cache_map: Dict[str,Dict[str|int,"CacheableDBObject"]]
-    #_reverse_map: Dict[CacheableDBObject,Dict[str,str|int]]
+    _multi_map: Dict[str,Dict[str|int,Set["CacheableDBObject"]]]
+    _complete: Dict[str,Set[str|int]]
+    _entries: "OrderedDict[int,_CacheEntry]"
+    _loading: Dict[Tuple[str,str|int],PendingLoad]
+    _absent: "OrderedDict[Tuple[str,str|int],float]"
     _cacheable_attributes: Tuple[str,...]
+    _multi_attributes: Tuple[str,...]
     _type: Type["CacheableDBObject"]
     _lock : RLock
+    _max_size: int
+    _ttl: float
+    _negative_max_size: int
+    _negative_ttl: float
     _hits: int
     _misses: int
-    
-    def __init__(self, type_: Type["CacheableDBObject"], cachable_attributes: Tuple[str,...]):
+    _evictions: int
+    _expirations: int
+    _invalidations: int
+    _negative_hits: int
+    _refreshes: int
+    _last_seen: Optional[datetime.datetime]
+
+    def __init__(self, type_: Type["CacheableDBObject"], cachable_attributes: Tuple[str,...], multi_attributes: Tuple[str,...] = (),
+                 max_size: Optional[int] = None, ttl: Optional[float] = None):
         self._lock = RLock()
         self._type = type_
         self._cacheable_attributes = cachable_attributes
+        self._multi_attributes = multi_attributes
         self._cache_map = {attr: {} for attr in self._cacheable_attributes}
+        self._multi_map = {attr: {} for attr in self._multi_attributes}
+        self._complete = {attr: set() for attr in self._multi_attributes}
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._absent = OrderedDict()
+        type_name = type_.__name__.lower()
+        self._max_size = max_size if max_size is not None else config.getint("cache", type_name+"_max_size", fallback=CACHE_MAX_SIZE)
+        self._ttl = ttl if ttl is not None else config.getfloat("cache", type_name+"_ttl_seconds", fallback=CACHE_TTL_SECONDS)
+        self._negative_max_size = CACHE_NEGATIVE_MAX_SIZE
+        self._negative_ttl = CACHE_NEGATIVE_TTL_SECONDS
         self._hits = 0
         self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+        self._negative_hits = 0
+        self._refreshes = 0
+        self._last_seen = None
+        _caches.append(self)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _unlink(self, entry: _CacheEntry) -> None:
+        del self._entries[entry.object.id]
+        for attr, key in entry.keys.items():
+            map = self._cache_map[attr]
+            if map.get(key) is entry.object:
+                del map[key]
+        for attr, key in entry.multi_keys.items():
+            objects = self._multi_map[attr].get(key)
+            if objects is not None:
+                objects.discard(entry.object)
+                if not objects:
+                    del self._multi_map[attr][key]
+            self._complete[attr].discard(key)
+
+    def _expired(self, entry: _CacheEntry) -> bool:
+        return entry.expires > 0 and entry.expires <= time.monotonic()
 
     def put(self, object: "CacheableDBObject"):
         with self._lock:
-            reverse_map: Dict[str,str|int] = {}
+            entry = self._entries.get(object.id)
+            if entry is not None:
+                self._unlink(entry)
+            keys: Dict[str,str|int] = {}
             for attr in self._cacheable_attributes:
-                map = self._cache_map[attr]
                 key = getattr(object, attr)
-                map[key] = object
-                self._cache_map[attr] = map
-                reverse_map[attr] = key
-            #self._reverse_map[object] = reverse_map
+                if key is None:
+                    # e.g. the computed uid of a symbol not flushed yet; None is not a key any object owns
+                    continue
+                displaced = self._cache_map[attr].get(key)
+                if displaced is not None and displaced is not object:
+                    # Another object currently owns this key, drop it so the maps stay consistent
+                    self._unlink(self._entries[displaced.id])
+                self._cache_map[attr][key] = object
+                keys[attr] = key
+                self._absent.pop((attr, key), None)
+            multi_keys: Dict[str,str|int] = {}
+            for attr in self._multi_attributes:
+                key = getattr(object, attr)
+                if key is None:
+                    continue
+                self._multi_map[attr].setdefault(key, set()).add(object)
+                multi_keys[attr] = key
+                self._absent.pop((attr, key), None)
+            self._entries[object.id] = _CacheEntry(object, keys, multi_keys, time.monotonic() + self._ttl if self._ttl > 0 else 0)
 
+            while self._max_size > 0 and len(self._entries) > self._max_size:
+                self._unlink(next(iter(self._entries.values())))
+                self._evictions += 1
+
+    def _lookup(self, attr: str, key: str|int) -> Optional["CacheableDBObject"]:
+        map = self._cache_map.get(attr)
+        if map is None:
+            logger.error("Attribute: %s is not a cacheable attribute for type: %s", attr, self._type)
+            raise KeyError(attr)
+        obj = map.get(key)
+        if obj is None:
+            return None
+        entry = self._entries[obj.id]
+        if self._expired(entry):
+            self._unlink(entry)
+            self._expirations += 1
+            return None
+        return obj
 
     def get(self, attr: str, key: str|int):
         with self._lock:
-            map = self._cache_map.get(attr)
-            if map is None:
-                logger.error("Attribute: %s is not a cacheable attribute for type: %s", attr, self._type)
-                raise
-            obj = map.get(key)
+            obj = self._lookup(attr, key)
             if obj:
                 self._hits += 1
-                #if self._hits % 1000 == 0:
-                #    logger.warning("%s Cache Gets: %s", self._type, self._hits)
+                self._entries.move_to_end(obj.id)
             else:
                 self._misses += 1
-                #if self._misses % 1000 == 0:
-                #    logger.warning("%s Cache Miesses: %s", self._type, self._misses)
             return obj
-        
-    """ def remove(self, object: CacheableDBObject):
+
+    def get_multi(self, attr: str, key: str|int) -> Optional[Set["CacheableDBObject"]]:
+        # Every cached object holding key, or None when the key is not known to be complete
         with self._lock:
-            reverse_map = self._reverse_map.get(object)
-            if reverse_map:
-                for attr, key in reverse_map.items():
-                    del self._cache_map[attr][key]
-            else:
-                logger.info("Object: %s is not cached for type: %s", object, CacheableDBObject) """
-    
+            if key not in self._complete[attr]:
+                self._misses += 1
+                return None
+            objects = set(self._multi_map[attr].get(key, ()))
+            expired = [obj for obj in objects if self._expired(self._entries[obj.id])]
+            for obj in expired:
+                self._unlink(self._entries[obj.id])
+                self._expirations += 1
+            if expired:
+                self._misses += 1
+                return None
+            self._hits += 1
+            for obj in objects:
+                self._entries.move_to_end(obj.id)
+            return objects
+
+    def mark_complete(self, attr: str, key: str|int, objects: Iterable["CacheableDBObject"]) -> None:
+        # Records that `objects` are all the rows holding key, provided they are all still cached
+        with self._lock:
+            if all(self._entries.get(obj.id) is not None and self._entries[obj.id].object is obj for obj in objects):
+                self._complete[attr].add(key)
+
+    def peek(self, attr: str, key: str|int) -> Optional["CacheableDBObject"]:
+        # Lookup that does not count towards hit/miss statistics or refresh recency
+        with self._lock:
+            return self._lookup(attr, key)
+
+    def mark_absent(self, attr: str, key: str|int) -> None:
+        with self._lock:
+            if self._negative_ttl <= 0 or self._negative_max_size <= 0 or key in self._cache_map.get(attr, self._multi_map.get(attr, {})):
+                return
+            self._absent[(attr, key)] = time.monotonic() + self._negative_ttl
+            self._absent.move_to_end((attr, key))
+            while len(self._absent) > self._negative_max_size:
+                self._absent.popitem(last=False)
+
+    def is_absent(self, attr: str, key: str|int) -> bool:
+        with self._lock:
+            expires = self._absent.get((attr, key))
+            if expires is None:
+                return False
+            if expires <= time.monotonic():
+                del self._absent[(attr, key)]
+                return False
+            self._negative_hits += 1
+            return True
+
+    def begin_load(self, attr: str, key: str|int) -> Tuple[Optional["CacheableDBObject"], Optional[PendingLoad], bool]:
+        # Returns (object, None, False) if the key got cached meanwhile or is known to be absent,
+        # otherwise the pending load for the key and whether the caller is the leader responsible for running the query
+        with self._lock:
+            obj = self._lookup(attr, key)
+            if obj is not None or self.is_absent(attr, key):
+                return obj, None, False
+            pending = self._loading.get((attr, key))
+            if pending is not None:
+                return None, pending, False
+            pending = PendingLoad()
+            self._loading[(attr, key)] = pending
+            return None, pending, True
+
+    def end_load(self, attr: str, key: str|int, pending: PendingLoad) -> None:
+        with self._lock:
+            if self._loading.get((attr, key)) is pending:
+                del self._loading[(attr, key)]
+
+    def refresh(self, object: "CacheableDBObject") -> bool:
+        # Applies a row changed by another process: the cached instance is updated in place (keeping its
+        # identity and version counter in step with the DB) and keys it newly holds stop being negative/complete
+        with self._lock:
+            for attr in self._cacheable_attributes:
+                self._absent.pop((attr, getattr(object, attr)), None)
+            for attr in self._multi_attributes:
+                key = getattr(object, attr)
+                self._absent.pop((attr, key), None)
+                self._complete[attr].discard(key)
+            entry = self._entries.get(object.id)
+            if entry is None:
+                return False
+            cached = entry.object
+            if getattr(cached, 'update_count', None) == getattr(object, 'update_count', None) and cached.update_stamp == object.update_stamp:
+                return False
+            for column_attr in self._type.__mapper__.column_attrs:
+                set_committed_value(cached, column_attr.key, getattr(object, column_attr.key))
+            self.put(cached)
+            self._refreshes += 1
+            return True
+
+    def remove(self, object: "CacheableDBObject") -> bool:
+        with self._lock:
+            entry = self._entries.get(object.id)
+            if entry is None or entry.object is not object:
+                logger.debug("Object: %s is not cached for type: %s", object, self._type)
+                return False
+            self._unlink(entry)
+            self._invalidations += 1
+            return True
+
+    def invalidate(self, attr: str, key: str|int) -> bool:
+        with self._lock:
+            obj = self._cache_map[attr].get(key)
+            return self.remove(obj) if obj is not None else False
+
+    def clear(self) -> None:
+        with self._lock:
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._absent.clear()
+            for map in self._multi_map.values():
+                map.clear()
+            for keys in self._complete.values():
+                keys.clear()
+            for map in self._cache_map.values():
+                map.clear()
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            expired = [entry for entry in self._entries.values() if self._expired(entry)]
+            for entry in expired:
+                self._unlink(entry)
+            self._expirations += len(expired)
+            return len(expired)
+
+    def estimated_bytes(self, sample_size: int = 100) -> int:
+        # Extrapolates the footprint of a sample of cached objects (instance state and values) to the whole cache
+        with self._lock:
+            size = sum(sys.getsizeof(map) for map in self._cache_map.values()) + sys.getsizeof(self._entries)
+            size += sum(sys.getsizeof(map) + sum(sys.getsizeof(objects) for objects in map.values()) for map in self._multi_map.values())
+            if not self._entries:
+                return size
+            sample = list(itertools.islice(reversed(self._entries.values()), sample_size))
+            sampled = 0
+            for entry in sample:
+                state = vars(entry.object)
+                sampled += sys.getsizeof(entry) + sys.getsizeof(entry.object) + sys.getsizeof(state)
+                sampled += sum(sys.getsizeof(value) for value in state.values())
+            return size + sampled * len(self._entries) // len(sample)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'max_size': self._max_size,
+                'ttl_seconds': self._ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': self._hits / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+                'negative_size': len(self._absent),
+                'negative_hits': self._negative_hits,
+                'refreshes': self._refreshes,
+                'estimated_bytes': self.estimated_bytes(),
+            }
+
+def cache_stats() -> Dict[str, Dict[str, float]]:
+    return {cache._type.__name__: cache.stats() for cache in _caches}
+
+def warm_caches(snapshot: bool = CACHE_SNAPSHOT, types: Optional[Iterable[Type["CacheableDBObject"]]] = None) -> None:
+    # Warms every cached type, or only the given ones
+    types = set(types) if types is not None else None
+    for cache in _caches:
+        if types is None or cache._type in types:
+            cache._type.restore_cache(snapshot)
+
+def refresh_caches() -> int:
+    return sum(cache._type.refresh_cache() for cache in _caches)
+
+class CacheCoherencePoller:
+    # Background thread polling every cached type for rows changed by other processes
+    _interval: float
+    _stop: Event
+    _thread: Optional[Thread]
+
+    def __init__(self, interval: float = CACHE_COHERENCE_INTERVAL):
+        self._interval = interval
+        self._stop = Event()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            try:
+                refresh_caches()
+            except Exception as ex:
+                logger.error("Cache coherence poll failed")
+                logger.error(ex)
+
+    def start(self) -> "CacheCoherencePoller":
+        if self._interval > 0 and self._thread is None:
+            for cache in _caches:
+                cache._type.refresh_cache()
+            self._thread = Thread(target=self._run, name='CacheCoherence', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def _cache_metrics() -> Iterator[Sample]:
+    for name, stats in cache_stats().items():
+        labels = {'cache': name}
+        for key in ('hits', 'misses', 'evictions', 'expirations', 'invalidations', 'negative_hits', 'refreshes'):
+            yield 'cache_'+key, labels, stats[key], 'counter'
+        for key in ('size', 'max_size', 'negative_size', 'estimated_bytes'):
+            yield 'cache_'+key, labels, stats[key], 'gauge'
+
+metrics.register_collector(_cache_metrics)
+
+METRICS_FILE: str = config.get("metrics", "file", fallback=WORKING_DIR+os.sep+'stage'+os.sep+'metrics.prom')
+METRICS_PORT: int = config.getint("metrics", "port", fallback=0)
+
+def export_metrics(path: str = METRICS_FILE, summary: bool = False) -> None:
+    # Writes the Prometheus text file (for node_exporter's textfile collector) and optionally logs the summary table
+    if path:
+        metrics.write(path)
+    if summary:
+        metrics.log_summary()
+
+def start_metrics_server(port: int = METRICS_PORT) -> Optional[MetricsServer]:
+    if port <= 0:
+        return None
+    return MetricsServer(metrics, port).start()
+
+def log_cache_stats() -> None:
+    for name, stats in cache_stats().items():
+        logger.info("%s cache: %d/%d objects, hit ratio %.3f (%d hits, %d misses), %d evictions, %d expirations, ~%d KB",
+                    name, stats['size'], stats['max_size'], stats['hit_ratio'], stats['hits'], stats['misses'],
+                    stats['evictions'], stats['expirations'], stats['estimated_bytes'] // 1024)
+
 class DBObject(Base):
     __abstract__ = True
     id: Mapped[int] = mapped_column(Integer, primary_key=True, sort_order=-1, autoincrement=False)
@@ -150,65 +906,313 @@ class DBObject(Base):
 
     #__mapper_args__ = {"version_id_col": update_count}
 
-    def __init__(self):
-        self.id = get_next_id()
+    def __init__(self, id: Optional[int] = None):
+        self.id = id if id is not None else get_next_id()
 
 class CacheableDBObject(DBObject):
     __abstract__ = True
     _cache: "DBObjectCache"
     _cacheable_attributes: Tuple[str, ...]
+    _multi_cacheable_attributes: Tuple[str, ...] = ()
     _attribute_to_column_map: Dict[str, Column]
 
     @classmethod
     def get_from_cache(cls,cache_key: str|int, cache_attribute: str) -> Optional["CacheableDBObject"]:
-        with cls._cache._lock:
+        # Hits only take the cache lock briefly; concurrent misses on the same key share one query
+        cache_object = cls._cache.get(cache_attribute,cache_key)
+        if cache_object:
+            return cache_object
+
+        cache_object, pending, leader = cls._cache.begin_load(cache_attribute, cache_key)
+        if pending is None:
+            return cache_object
+        if not leader:
+            return pending.wait()
+
+        try:
+            with Session() as session:
+                cache_object = session.scalars(select(cls).filter_by(**{cache_attribute:cache_key})).first()
+            if cache_object:
+                cls._cache.put(cache_object)
+            else:
+                cls._cache.mark_absent(cache_attribute, cache_key)
+            pending.resolve(cache_object)
+        except Exception as error:
+            pending.fail(error)
+            raise
+        finally:
+            cls._cache.end_load(cache_attribute, cache_key, pending)
+        return cache_object
+
+    @classmethod
+    def _load_by_keys(cls, session: SessionType, attribute_column: Column, keys: List[str|int], staging: bool) -> Iterator["CacheableDBObject"]:
+        # Loads objects for a key list in CACHE_LOAD_BATCH_SIZE IN-list chunks, or by joining
+        # against a temporary table holding the keys when staging is requested
+        if staging:
+            staging_table = Table("tmp_"+cls.__tablename__+"_keys", MetaData(), Column("cache_key", attribute_column.type, primary_key=True), prefixes=["TEMPORARY"])
+            conn = session.connection()
+            staging_table.create(conn)
+            try:
+                for start in range(0, len(keys), CACHE_LOAD_BATCH_SIZE):
+                    conn.execute(staging_table.insert(), [{'cache_key': key} for key in keys[start:start+CACHE_LOAD_BATCH_SIZE]])
+                yield from session.scalars(select(cls).join(staging_table, staging_table.c.cache_key == attribute_column)
+                                           .execution_options(yield_per=CACHE_LOAD_BATCH_SIZE))
+            finally:
+                staging_table.drop(conn)
+        else:
+            for start in range(0, len(keys), CACHE_LOAD_BATCH_SIZE):
+                yield from session.scalars(select(cls).where(attribute_column.in_(keys[start:start+CACHE_LOAD_BATCH_SIZE])))
+
+    @classmethod
+    def get_all_from_cache(cls, cache_keys: Iterable[str] | Iterable[int], cache_attribute: str, staging: Optional[bool] = None) -> Dict[str|int, "CacheableDBObject"]:
+        # Returns the found objects keyed by cache_attribute. staging defaults to using a temporary
+        # key table once the number of keys to load reaches [cache] staging_table_threshold
+        hits: Dict[str|int, "CacheableDBObject"] = {}
+        attribute_column = cls._attribute_to_column_map.get(cache_attribute)
+        if attribute_column is None:
+            logger.error(f"Attribute: {cache_attribute} is not a cacheable attribute for type: {cls.__name__}")
+            logger.error(f"_cacheable_attributes: {cls._attribute_to_column_map.items()}")
+            raise KeyError(cache_attribute)
+
+        misses: Set[str] | Set[int] = set()
+        for cache_key in cache_keys:
             cache_object = cls._cache.get(cache_attribute,cache_key)
-            if not cache_object:
+            if cache_object:
+                hits[cache_key] = cache_object
+            else:
+                misses.add(cache_key)
+
+        # Load the keys nobody else is loading, then wait for the rest
+        leading: Dict[str|int, PendingLoad] = {}
+        waiting: List[Tuple[str|int, PendingLoad]] = []
+        for cache_key in misses:
+            cache_object, pending, leader = cls._cache.begin_load(cache_attribute, cache_key)
+            if pending is None:
+                if cache_object is not None:
+                    hits[cache_key] = cache_object
+            elif leader:
+                leading[cache_key] = pending
+            else:
+                waiting.append((cache_key, pending))
+
+        if leading:
+            if staging is None:
+                staging = CACHE_STAGING_THRESHOLD > 0 and len(leading) >= CACHE_STAGING_THRESHOLD
+            try:
                 with Session() as session:
-                    cache_object = session.scalars(select(cls).filter_by(**{cache_attribute:cache_key})).first()
-                    if cache_object:
+                    for cache_object in cls._load_by_keys(session, attribute_column, list(leading.keys()), staging):
                         cls._cache.put(cache_object)
+                        cache_key = getattr(cache_object, cache_attribute)
+                        hits[cache_key] = cache_object
+                        pending = leading.get(cache_key)
+                        if pending is not None:
+                            pending.resolve(cache_object)
+                for cache_key, pending in leading.items():
+                    if cache_key not in hits:
+                        cls._cache.mark_absent(cache_attribute, cache_key)
+                        pending.resolve(None)
+            except Exception as error:
+                for pending in leading.values():
+                    pending.fail(error)
+                raise
+            finally:
+                for cache_key, pending in leading.items():
+                    cls._cache.end_load(cache_attribute, cache_key, pending)
 
-            return cache_object
-        
+        for cache_key, pending in waiting:
+            cache_object = pending.wait()
+            if cache_object:
+                hits[cache_key] = cache_object
+        return hits
 
     @classmethod
-    def get_all_from_cache(cls, cache_keys: Iterable[str] | Iterable[int], cache_attribute: str) -> Set["CacheableDBObject"]:
-        with cls._cache._lock:
-            hits: Set["CacheableDBObject"] = set()
-            misses: Set[str] | Set[int] = set()
-            attribute_column = cls._attribute_to_column_map.get(cache_attribute)
-            if attribute_column is None:
-                logger.error(f"Attribute: {cache_attribute} is not a cacheable attribute for type: {cls.__name__}")
-                logger.error(f"_cacheable_attributes: {cls._attribute_to_column_map.items()}")
-                raise
-            for cache_key in cache_keys:
-                cache_object = cls._cache.get(cache_attribute,cache_key)
-                if cache_object:
-                    hits.add(cache_object)
-                else:
-                    misses.add(cache_key)
+    def get_all_by(cls, cache_keys: Iterable[str] | Iterable[int], cache_attribute: str, staging: Optional[bool] = None) -> Dict[str|int, Set["CacheableDBObject"]]:
+        # Bulk lookup on a non-unique attribute, returning every object per key for the keys that exist.
+        # Keys not complete in the cache are loaded together in chunked queries
+        if cache_attribute not in cls._multi_cacheable_attributes:
+            logger.error(f"Attribute: {cache_attribute} is not a multi-valued cacheable attribute for type: {cls.__name__}")
+            raise KeyError(cache_attribute)
+        attribute_column = cls._attribute_to_column_map[cache_attribute]
+
+        hits: Dict[str|int, Set["CacheableDBObject"]] = {}
+        misses: List[str|int] = []
+        for cache_key in set(cache_keys):
+            objects = cls._cache.get_multi(cache_attribute, cache_key)
+            if objects:
+                hits[cache_key] = objects
+            elif objects is None and not cls._cache.is_absent(cache_attribute, cache_key):
+                misses.append(cache_key)
+
+        if misses:
+            if staging is None:
+                staging = CACHE_STAGING_THRESHOLD > 0 and len(misses) >= CACHE_STAGING_THRESHOLD
+            loaded: Dict[str|int, Set["CacheableDBObject"]] = {cache_key: set() for cache_key in misses}
             with Session() as session:
-                cache_objects = session.scalars(select(cls).where(attribute_column.in_(misses))).fetchall()
-                for cache_object in cache_objects:
-                    cls._cache.put(cache_object)
-                    hits.add(cache_object)
-            return hits
-        
+                for cache_object in cls._load_by_keys(session, attribute_column, misses, staging):
+                    # Keep the instance already cached for this id so every index points at one object
+                    cached = cls._cache.peek('id', cache_object.id) if 'id' in cls._cacheable_attributes else None
+                    if cached is None or getattr(cached, cache_attribute) != getattr(cache_object, cache_attribute):
+                        cls._cache.put(cache_object)
+                        cached = cache_object
+                    loaded.setdefault(getattr(cache_object, cache_attribute), set()).add(cached)
+            for cache_key, objects in loaded.items():
+                if objects:
+                    cls._cache.mark_complete(cache_attribute, cache_key, objects)
+                    hits[cache_key] = objects
+                else:
+                    cls._cache.mark_absent(cache_attribute, cache_key)
+        return hits
+
+    @classmethod
+    def get_by(cls, cache_key: str|int, cache_attribute: str) -> Set["CacheableDBObject"]:
+        return cls.get_all_by((cache_key,), cache_attribute).get(cache_key, set())
+
     @classmethod
     def add_to_cache(cls, object: "CacheableDBObject"):
         with cls._cache._lock:
             cls._cache.put(object)
 
+    @classmethod
+    def remove_from_cache(cls, object: "CacheableDBObject") -> bool:
+        return cls._cache.remove(object)
+
+    @classmethod
+    def invalidate_cache(cls, cache_key: Optional[str|int] = None, cache_attribute: str = 'id') -> None:
+        # Drops one object, or the whole cache when no key is given
+        if cache_key is None:
+            cls._cache.clear()
+        else:
+            cls._cache.invalidate(cache_attribute, cache_key)
+
+    @classmethod
+    def cache_stats(cls) -> Dict[str, float]:
+        return cls._cache.stats()
+
+    @classmethod
+    def _warm_criteria(cls) -> List:
+        # Where clauses selecting the rows worth preloading, all rows by default
+        return []
+
+    @classmethod
+    def _max_update_stamp(cls) -> Optional[datetime.datetime]:
+        update_stamp = cls.__table__.c.get('update_stamp')
+        if update_stamp is None:
+            return None
+        with Session() as session:
+            return session.scalar(select(func.max(update_stamp)))
+
+    @classmethod
+    def warm_cache(cls, since: Optional[datetime.datetime] = None) -> int:
+        # Streams the rows selected by _warm_criteria into the cache with one query, only those stamped
+        # at or after `since` when refreshing a restored snapshot. Those deltas are read unfiltered so
+        # rows that stopped matching _warm_criteria since the snapshot leave the cache
+        criteria = cls._warm_criteria()
+        start = time.perf_counter()
+        count = 0
+        with Session() as session:
+            if since is None:
+                cls._cache._last_seen = cls._max_update_stamp()
+                for cache_object in session.scalars(select(cls).where(*criteria).execution_options(yield_per=CACHE_WARM_BATCH_SIZE)):
+                    cls._cache.put(cache_object)
+                    count += 1
+            else:
+                stmt = select(cls, and_(true(), *criteria).label('warm')).where(cls.__table__.c.update_stamp >= since)
+                for cache_object, warm in session.execute(stmt.execution_options(yield_per=CACHE_WARM_BATCH_SIZE)):
+                    if warm:
+                        cls._cache.put(cache_object)
+                        count += 1
+                    else:
+                        cls._cache.invalidate('id', cache_object.id)
+        logger.info("Loaded %d %s objects into cache in %.3f s", count, cls.__name__, time.perf_counter() - start)
+        if cls._cache._max_size > 0 and count > cls._cache._max_size:
+            logger.warning("%s cache capacity %d is smaller than the %d warmed rows", cls.__name__, cls._cache._max_size, count)
+        return count
+
+    @classmethod
+    def _snapshot_path(cls) -> str:
+        return CACHE_SNAPSHOT_DIR+os.sep+'cache_'+cls.__name__+'.pkl'
+
+    @classmethod
+    def save_cache_snapshot(cls, update_stamp: Optional[datetime.datetime] = None, path: Optional[str] = None) -> None:
+        # Pickles the cached objects together with the max update_stamp they reflect
+        path = path or cls._snapshot_path()
+        update_stamp = update_stamp if update_stamp is not None else cls._max_update_stamp()
+        with cls._cache._lock:
+            objects = [entry.object for entry in cls._cache._entries.values()]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path+'.tmp', 'wb') as f:
+            pickle.dump((update_stamp, objects), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path+'.tmp', path)
+        logger.info("Saved %d %s objects to cache snapshot %s", len(objects), cls.__name__, path)
+
+    @classmethod
+    def load_cache_snapshot(cls, path: Optional[str] = None) -> Optional[datetime.datetime]:
+        # Restores a snapshot into the cache, returning the update_stamp it was taken at
+        path = path or cls._snapshot_path()
+        if not os.path.exists(path):
+            return None
+        start = time.perf_counter()
+        try:
+            with open(path, 'rb') as f:
+                update_stamp, objects = pickle.load(f)
+        except Exception as error:
+            logger.warning("Unable to read cache snapshot %s: %s", path, error)
+            return None
+        for cache_object in objects:
+            cls._cache.put(cache_object)
+        logger.info("Restored %d %s objects from cache snapshot in %.3f s", len(objects), cls.__name__, time.perf_counter() - start)
+        return update_stamp
+
+    @classmethod
+    def restore_cache(cls, snapshot: bool = CACHE_SNAPSHOT) -> int:
+        # Warm start: restore the snapshot and fetch only rows changed since it was taken,
+        # falling back to a full warm-up when there is no usable snapshot
+        if not snapshot:
+            return cls.warm_cache()
+        current_stamp = cls._max_update_stamp()
+        snapshot_stamp = cls.load_cache_snapshot()
+        if snapshot_stamp is None:
+            count = cls.warm_cache()
+        elif current_stamp is not None and current_stamp > snapshot_stamp:
+            count = cls.warm_cache(since=snapshot_stamp)
+        else:
+            cls._cache._last_seen = current_stamp
+            return 0
+        cls._cache._last_seen = current_stamp
+        cls.save_cache_snapshot(current_stamp)
+        return count
+
+    @classmethod
+    def refresh_cache(cls) -> int:
+        # Delta poll on update_stamp: refreshes cached objects changed since the last poll. update_stamp
+        # only has second precision, so rows stamped at last_seen are re-read and skipped when unchanged
+        update_stamp = cls.__table__.c.get('update_stamp')
+        if update_stamp is None:
+            return 0
+        last_seen = cls._cache._last_seen
+        if last_seen is None:
+            cls._cache._last_seen = cls._max_update_stamp()
+            return 0
+        refreshed = 0
+        with Session() as session:
+            for row in session.scalars(select(cls).where(update_stamp >= last_seen).execution_options(yield_per=CACHE_WARM_BATCH_SIZE)):
+                if row.update_stamp is not None and row.update_stamp > last_seen:
+                    cls._cache._last_seen = max(cls._cache._last_seen, row.update_stamp)
+                if cls._cache.refresh(row):
+                    refreshed += 1
+        if refreshed:
+            logger.info("Refreshed %d %s objects changed by other processes", refreshed, cls.__name__)
+        return refreshed
+
     def __init__(self):
         super().__init__()
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
-        cls._cache = DBObjectCache(cls, cls._cacheable_attributes)
+        cls._cache = DBObjectCache(cls, cls._cacheable_attributes, cls._multi_cacheable_attributes)
 
         ins = inspect(cls)
-        for cache_att in cls._cacheable_attributes:
+        for cache_att in cls._cacheable_attributes + cls._multi_cacheable_attributes:
             logger.debug(f"initializing cacheable attribute: {cache_att} for type: {cls.__name__}")
             col = ins.columns.get(cache_att)
             if col is not None:
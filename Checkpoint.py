@@ -0,0 +1,280 @@
+import time
+import logging
+import numpy as np
+from datetime import date, datetime, timedelta
+from threading import RLock
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select, update, insert, delete, bindparam, case, Connection
+
+from Base import config, get_engine, get_next_id, get_id_array, BulkWriter
+from FinnHubClasses import JobRun, JobRunItem
+from Metrics import metrics
+
+logger = logging.getLogger('DB')
+
+CHECKPOINT_ENABLED: bool = config.getboolean("checkpoint", "enabled", fallback=True)
+CHECKPOINT_BATCH_SIZE: int = config.getint("checkpoint", "batch_size", fallback=500)
+CHECKPOINT_BATCH_SECONDS: float = config.getfloat("checkpoint", "batch_seconds", fallback=30)
+CHECKPOINT_MAX_AGE_HOURS: float = config.getfloat("checkpoint", "max_age_hours", fallback=24)
+
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_ABANDONED = 'abandoned'
+
+JOB_ITEM_PENDING = 0
+JOB_ITEM_COMPLETED = 1
+JOB_ITEM_FAILED = 2
+
+# (symbol_key, start_date) as planned by the job
+PlanItem = Tuple[int, Optional[date]]
+Marks = Dict[int, Tuple[int, Optional[str]]]
+# Positions written by complete() and the buffered marks it drained, for confirm() or discard() once the caller's transaction ends
+ClaimedMarks = Tuple[List[int], Marks]
+
+ITEM_STATUS_STMT = update(JobRunItem.__table__)\
+                    .where(JobRunItem.__table__.c.job_run_key == bindparam('b_run'))\
+                    .where(JobRunItem.__table__.c.position == bindparam('b_position'))\
+                    .values(status=bindparam('b_status'), error=bindparam('b_error'))
+
+class JobCheckpoint:
+    # Durable progress of one JobRun. Items are marked completed or failed by symbol_key; marks are
+    # buffered and written in batches of batch_size or every batch_seconds, or immediately inside the
+    # caller's transaction through complete(), so a checkpoint never claims data that was not committed.
+    # The in-memory cursor only moves once the caller confirm()s its commit. A restart resumes the pending
+    # items of the last running run with the same plan_key. Items are only kept while their run is running,
+    # JobRun keeps the counts of finished and abandoned runs
+    job: str
+    run_id: int
+    _positions: Dict[int, int]
+    _cursor: int
+    _finished: Set[int]
+    _inflight: Set[int]
+    _pending: Marks
+    _batch_size: int
+    _max_wait: float
+    _last_flush: float
+    _lock: RLock
+
+    def __init__(self, job: str, run_id: int, positions: Dict[int, int], cursor: int = 0, finished: Iterable[int] = (),
+                 batch_size: int = CHECKPOINT_BATCH_SIZE, max_wait: float = CHECKPOINT_BATCH_SECONDS):
+        self.job = job
+        self.run_id = run_id
+        self._positions = positions
+        self._cursor = cursor
+        self._finished = set(finished)
+        self._inflight = set()
+        self._pending = {}
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._last_flush = time.monotonic()
+        self._lock = RLock()
+
+    @staticmethod
+    def _delete_items(conn: Connection, run_ids: List[int]) -> None:
+        if run_ids:
+            items = JobRunItem.__table__
+            result = conn.execute(delete(items).where(items.c.job_run_key.in_(run_ids)))
+            logger.debug("Deleted %d items of %d finished runs", result.rowcount, len(run_ids))
+
+    @classmethod
+    def _abandon(cls, conn: Connection, job: str) -> None:
+        table = JobRun.__table__
+        run_ids = conn.scalars(select(table.c.id).where(table.c.job == job).where(table.c.status == JOB_RUNNING)).all()
+        if run_ids:
+            conn.execute(update(table).where(table.c.id.in_(run_ids)).values(status=JOB_ABANDONED, updated=datetime.now()))
+            cls._delete_items(conn, run_ids)
+            logger.info("Abandoned %d unfinished %s runs", len(run_ids), job)
+
+    @classmethod
+    def start(cls, job: str, plan: List[PlanItem], plan_key: Optional[str] = None) -> "JobCheckpoint":
+        # Records the run and its full plan in one transaction, abandoning earlier unfinished runs of the job
+        run_id = get_next_id()
+        now = datetime.now()
+        items = BulkWriter(JobRunItem.__table__, auto_flush=False)
+        if plan:
+            symbol_keys = np.fromiter((symbol_key for symbol_key, _ in plan), dtype=np.int64, count=len(plan))
+            start_dates = np.empty(len(plan), dtype=object)
+            start_dates[:] = [start_date for _, start_date in plan]
+            items.add_columns({
+                'id': get_id_array(len(plan)),
+                'job_run_key': np.full(len(plan), run_id, dtype=np.int64),
+                'position': np.arange(len(plan), dtype=np.int64),
+                'symbol_key': symbol_keys,
+                'start_date': start_dates,
+                'status': np.full(len(plan), JOB_ITEM_PENDING, dtype=np.int64),
+            })
+        with get_engine().begin() as conn:
+            cls._abandon(conn, job)
+            conn.execute(insert(JobRun.__table__).values(id=run_id, job=job, plan_key=plan_key, status=JOB_RUNNING, planned=len(plan),
+                                                         completed=0, failed=0, cursor_position=0, started=now, updated=now))
+            items.flush(conn)
+        logger.info("Started %s run %d with %d planned items", job, run_id, len(plan))
+        return cls(job, run_id, {symbol_key: position for position, (symbol_key, _) in enumerate(plan)})
+
+    @classmethod
+    def resume(cls, job: str, plan_key: Optional[str] = None, max_age_hours: float = CHECKPOINT_MAX_AGE_HOURS) -> Optional[Tuple["JobCheckpoint", List[PlanItem]]]:
+        # The last running run of the job and its pending items in plan order, unless it is stale or was planned for another plan_key
+        runs = JobRun.__table__
+        items = JobRunItem.__table__
+        with get_engine().begin() as conn:
+            run = conn.execute(select(runs.c.id, runs.c.plan_key, runs.c.started, runs.c.cursor_position, runs.c.completed, runs.c.failed, runs.c.planned)
+                               .where(runs.c.job == job)
+                               .where(runs.c.status == JOB_RUNNING)
+                               .order_by(runs.c.started.desc())
+                               .limit(1)).first()
+            if run is None:
+                return None
+            if run.plan_key != plan_key or (max_age_hours > 0 and run.started < datetime.now() - timedelta(hours=max_age_hours)):
+                logger.info("Not resuming %s run %d started at %s for %s", job, run.id, run.started, run.plan_key)
+                cls._abandon(conn, job)
+                return None
+            rows = conn.execute(select(items.c.position, items.c.symbol_key, items.c.start_date, items.c.status)
+                                .where(items.c.job_run_key == run.id)
+                                .where(items.c.position >= run.cursor_position)
+                                .order_by(items.c.position)).all()
+        positions = {row.symbol_key: row.position for row in rows}
+        finished = [row.position for row in rows if row.status != JOB_ITEM_PENDING]
+        plan = [(row.symbol_key, row.start_date) for row in rows if row.status == JOB_ITEM_PENDING]
+        logger.info("Resuming %s run %d: %d of %d items done (%d failed), %d pending from position %d",
+                    job, run.id, run.completed + run.failed, run.planned, run.failed, len(plan), run.cursor_position)
+        metrics.inc('checkpoint_resumes', job=job)
+        return cls(job, run.id, positions, run.cursor_position, finished), plan
+
+    @classmethod
+    def begin(cls, job: str, plan_fn: Callable[[], List[PlanItem]], plan_key: Optional[str] = None) -> Tuple[Optional["JobCheckpoint"], List[PlanItem]]:
+        # Resumes the job's unfinished run or plans a new one; without checkpoints this is just plan_fn()
+        if not CHECKPOINT_ENABLED:
+            return None, plan_fn()
+        resumed = cls.resume(job, plan_key)
+        if resumed is not None:
+            return resumed
+        plan = plan_fn()
+        return cls.start(job, plan, plan_key), plan
+
+    def _mark(self, symbol_key: int, status: int, error: Optional[str] = None) -> None:
+        with self._lock:
+            if symbol_key in self._positions:
+                self._pending[symbol_key] = (status, error[:255] if error else None)
+            due = len(self._pending) >= self._batch_size or time.monotonic() - self._last_flush >= self._max_wait
+        if due:
+            try:
+                self.flush()
+            except Exception as ex:
+                # The marks stay buffered for the next flush
+                logger.error("Failed to write %s checkpoint marks", self.job)
+                logger.error(ex)
+
+    def done(self, symbol_key: int) -> None:
+        # For items that wrote no data, e.g. no new quotes; items with data go through complete()
+        self._mark(symbol_key, JOB_ITEM_COMPLETED)
+
+    def fail(self, symbol_key: int, error: str) -> None:
+        self._mark(symbol_key, JOB_ITEM_FAILED, error)
+
+    def _take(self, marks: Marks) -> Tuple[List[Dict], int, int, int]:
+        # Claims marks for items neither finished nor claimed by another open transaction. The cursor
+        # written counts this batch as finished, the in-memory one waits for confirm()
+        with self._lock:
+            params = []
+            completed = failed = 0
+            for symbol_key, (status, error) in marks.items():
+                position = self._positions.get(symbol_key)
+                if position is None or position < self._cursor or position in self._finished or position in self._inflight:
+                    continue
+                self._inflight.add(position)
+                params.append({'b_run': self.run_id, 'b_position': position, 'b_status': status, 'b_error': error})
+                if status == JOB_ITEM_COMPLETED:
+                    completed += 1
+                else:
+                    failed += 1
+            claimed = {param['b_position'] for param in params}
+            cursor = self._cursor
+            while cursor in self._finished or cursor in claimed:
+                cursor += 1
+            return params, completed, failed, cursor
+
+    def _write(self, conn: Connection, marks: Marks) -> List[int]:
+        # Statements run outside the lock, the caller's transaction may be waiting on the DB
+        params, completed, failed, cursor = self._take(marks)
+        positions = [param['b_position'] for param in params]
+        if not params:
+            return positions
+        runs = JobRun.__table__
+        try:
+            conn.execute(ITEM_STATUS_STMT, params)
+            conn.execute(update(runs)
+                         .where(runs.c.id == self.run_id)
+                         .values(completed=runs.c.completed + completed,
+                                 failed=runs.c.failed + failed,
+                                 cursor_position=case((runs.c.cursor_position < cursor, cursor), else_=runs.c.cursor_position),
+                                 updated=datetime.now()))
+        except Exception:
+            with self._lock:
+                self._inflight.difference_update(positions)
+            raise
+        metrics.inc('checkpoint_items', completed, job=self.job, status='completed')
+        metrics.inc('checkpoint_items', failed, job=self.job, status='failed')
+        return positions
+
+    def _drain(self) -> Marks:
+        with self._lock:
+            marks = self._pending
+            self._pending = {}
+            self._last_flush = time.monotonic()
+            return marks
+
+    def complete(self, conn: Connection, symbol_keys: Iterable[int]) -> ClaimedMarks:
+        # Marks items completed in the caller's transaction, together with any buffered marks. The caller
+        # passes the result to confirm() after its commit or to discard() after a rollback
+        drained = self._drain()
+        marks = dict(drained)
+        marks.update((symbol_key, (JOB_ITEM_COMPLETED, None)) for symbol_key in symbol_keys)
+        try:
+            return self._write(conn, marks), drained
+        except Exception:
+            self._restore(drained)
+            raise
+
+    def confirm(self, claimed: ClaimedMarks) -> None:
+        positions, _ = claimed
+        with self._lock:
+            self._inflight.difference_update(positions)
+            self._finished.update(positions)
+            while self._cursor in self._finished:
+                self._finished.discard(self._cursor)
+                self._cursor += 1
+
+    def discard(self, claimed: ClaimedMarks) -> None:
+        # The items of a rolled back transaction can be claimed again, its buffered marks go back in the buffer
+        positions, drained = claimed
+        with self._lock:
+            self._inflight.difference_update(positions)
+        self._restore(drained)
+
+    def _restore(self, marks: Marks) -> None:
+        with self._lock:
+            for symbol_key, mark in marks.items():
+                self._pending.setdefault(symbol_key, mark)
+
+    def flush(self) -> None:
+        marks = self._drain()
+        if not marks:
+            return
+        positions = []
+        try:
+            with get_engine().begin() as conn:
+                positions = self._write(conn, marks)
+        except Exception:
+            self.discard((positions, marks))
+            raise
+        self.confirm((positions, marks))
+
+    def finish(self, status: str = JOB_COMPLETED) -> None:
+        self.flush()
+        runs = JobRun.__table__
+        now = datetime.now()
+        with get_engine().begin() as conn:
+            conn.execute(update(runs).where(runs.c.id == self.run_id).values(status=status, updated=now, finished=now))
+            self._delete_items(conn, [self.run_id])
+        logger.info("Finished %s run %d: %s", self.job, self.run_id, status)
@@ -1,18 +1,20 @@
 import time
 import hashlib
 import traceback
+import numpy as np
 import pandas as pd
 from datetime import date, timedelta, datetime
 from typing import Tuple, List, Set, Any, Dict, Optional
 
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, Float, UniqueConstraint, Index, Boolean, func, Computed, DateTime, Date, select, text, BigInteger, Column
+from sqlalchemy import Integer, String, Float, UniqueConstraint, Index, Boolean, func, Computed, DateTime, Date, select, text, BigInteger, Column, update
 
 
 #from DB import DBConnection
 import logging
 
-from Base import Base, Session, engine, CacheableDBObject, DBObject
+from Base import Base, Session, CacheableDBObject, DBObject, ColumnData, get_id_array
+from Reconcile import parse_feed_date
 
 logger = logging.getLogger('FinnHub')
 
@@ -96,7 +98,7 @@ class StockSymbol(CacheableDBObject):
     #update_count: Mapped[int] = mapped_column(Integer,server_default=text("0"))
     last_finnhub_quote_check: Mapped[Optional[datetime]] = mapped_column(DateTime)
     #last_finnhub_quote_check: Mapped[Optional[date]] = mapped_column(Date)
-    last_yahoo_quote_check: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    last_yahoo_quote_check: Mapped[Optional[date]] = mapped_column(Date)
     create_stamp: Mapped[datetime] = mapped_column(DateTime, sort_order=100, default=datetime.now)
     update_count: Mapped[int] = mapped_column(Integer, sort_order=101, default=0)
     update_stamp: Mapped[datetime] = mapped_column(DateTime, sort_order=102, default=datetime.now)
@@ -126,13 +128,35 @@ class StockSymbol(CacheableDBObject):
     __table_args__ = (
         UniqueConstraint("symbol", "exchange_key", name="ux_Symbol_symbol_exchange"),
         UniqueConstraint("uid", name="ux_Symbol_uid"),
+        Index("ix_Symbol_last_yahoo_quote_check", "last_yahoo_quote_check"),
+        Index("ix_Symbol_figi", "figi"),
+        Index("ix_Symbol_isin", "isin"),
+        Index("ix_Symbol_share_class_figi", "share_class_figi"),
+        Index("ix_Symbol_update_stamp", "update_stamp"),
         #TODO: replace remove uid and replace with composite ux
         #UniqueConstraint("symbol","mic", name="ux_Symbol_symbol_mic")
     )
 
     _cacheable_attributes: Tuple[str, ...] = ("id", "uid",)
+    # Vendor identifiers and bare tickers are shared by several listings
+    _multi_cacheable_attributes: Tuple[str, ...] = ("figi", "isin", "share_class_figi", "symbol",)
     _attribute_to_column_map: Dict[str, Column] = {}
 
+    # Finnhub stock_symbols feed columns compared by Reconciler, keyed by attribute
+    _natural_key: str = "uid"
+    _feed_columns: Dict[str, str] = {
+        "currency": "currency",
+        "description": "description",
+        "display_symbol": "displaySymbol",
+        "figi": "figi",
+        "isin": "isin",
+        "share_class_figi": "shareClassFIGI",
+        "symbol": "symbol",
+        "symbol2": "symbol2",
+        "symbol_type": "type",
+        "finnhub_symbol": "finnhub_symbol",
+    }
+
     #cache_stmt = select(id,uid,hash,update_time)
     # TODO: remove uid and use concat
     #cache_stmt = select(id,func.concat(symbol,mic),hash,update_time)
@@ -145,6 +169,11 @@ class StockSymbol(CacheableDBObject):
     #def cache_init(cls):
     #    pass
 
+    @classmethod
+    def _warm_criteria(cls) -> List:
+        # Only symbols still listed by Finnhub are worth preloading
+        return [cls.finnhub_symbol == 1]
+
     @classmethod
     def parse_data(cls, df: pd.DataFrame) -> List["StockSymbol"]:
         symbols = []
@@ -170,6 +199,15 @@ class StockSymbol(CacheableDBObject):
             symbols.append(symbol)
         return symbols
     
+    @classmethod
+    def repair_yahoo_watermarks(cls) -> None:
+        # Rebuilds last_yahoo_quote_check from YahooQuote for every symbol
+        last_quote = select(func.max(YahooQuote.quote_date)).where(YahooQuote.symbol_key == cls.id).scalar_subquery()
+        with Session() as session:
+            res = session.execute(update(cls).values(last_yahoo_quote_check=last_quote))
+            session.commit()
+            logger.info(f"Rebuilt yahoo quote watermarks for {res.rowcount} Symbols")
+
     def __init__(self, mic: str, currency: str, description: str, display_symbol: str, figi: str, isin: str, share_class_figi: str, symbol: str, symbol2: str, symbol_type: str, finnhub_symbol: int):
         super().__init__()
         self.mic = mic
@@ -351,11 +389,33 @@ class Exchange(CacheableDBObject):
 
     __table_args__ = (
         UniqueConstraint("mic", name="ux_Exchange_mic"),
+        Index("ix_Exchange_update_stamp", "update_stamp"),
     )
 
     _cacheable_attributes: Tuple[str, ...] = ("id", "mic",)
     _attribute_to_column_map: Dict[str, Column] = {}
 
+    # ISO 10383 csv columns compared by Reconciler, keyed by attribute
+    _natural_key: str = "mic"
+    _feed_columns: Dict[str, str] = {
+        "operating_mic": "OPERATING MIC",
+        "oprt_sgmt": "OPRT/SGMT",
+        "market_name": "MARKET NAME-INSTITUTION DESCRIPTION",
+        "legal_entity_name": "LEGAL ENTITY NAME",
+        "lei": "LEI",
+        "market_category_code": "MARKET CATEGORY CODE",
+        "acronym": "ACRONYM",
+        "iso_country_code": "ISO COUNTRY CODE (ISO 3166)",
+        "city": "CITY",
+        "website": "WEBSITE",
+        "status": "STATUS",
+        "creation_date": "CREATION DATE",
+        "last_update_date": "LAST UPDATE DATE",
+        "last_validation_date": "LAST VALIDATION DATE",
+        "expiry_date": "EXPIRY DATE",
+        "comments": "COMMENTS",
+    }
+
     #cache_stmt = select(id,mic,hash,update_time)
     #_cache_sql = "SELECT id,mic,hash,update_time FROM Exchange"
     #_insert_sql = "INSERT INTO Exchange(mic,operating_mic,oprt_sgmt,market_name,legal_entity_name,lei,market_category_code,acronym,iso_country_code,city,website,status,creation_date,last_update_date,last_validation_date,expiry_date,comments,hash,update_time,id) VALUES(" + ','.join(["%s"]*20) + ')'
@@ -382,10 +442,10 @@ class Exchange(CacheableDBObject):
             city: str = exchange_data['CITY']
             website: str = exchange_data['WEBSITE']
             status: str = exchange_data['STATUS']
-            creation_date: date = date.fromisoformat(str(exchange_data['CREATION DATE'])) if exchange_data['CREATION DATE'] else None
-            last_update_date: date = date.fromisoformat(str(exchange_data['LAST UPDATE DATE'])) if exchange_data['LAST UPDATE DATE'] else None
-            last_validation_date: date = date.fromisoformat(str(exchange_data['LAST VALIDATION DATE'])) if exchange_data['LAST VALIDATION DATE'] else None
-            expiry_date: date = date.fromisoformat(str(exchange_data['EXPIRY DATE'])) if exchange_data['EXPIRY DATE'] else None
+            creation_date: date = parse_feed_date(exchange_data['CREATION DATE'])
+            last_update_date: date = parse_feed_date(exchange_data['LAST UPDATE DATE'])
+            last_validation_date: date = parse_feed_date(exchange_data['LAST VALIDATION DATE'])
+            expiry_date: date = parse_feed_date(exchange_data['EXPIRY DATE'])
             comments: str = exchange_data['COMMENTS']
             
             exchange = cls(mic=mic, operating_mic=operating_mic, oprt_sgmt=oprt_sgmt, market_name=market_name, legal_entity_name=legal_entity_name, lei=lei, 
@@ -471,19 +531,19 @@ class Exchange(CacheableDBObject):
             self.status = exchange_data['STATUS']
             changed = True
 
-        creation_date: date = date.fromisoformat(str(exchange_data['CREATION DATE'])) if exchange_data['CREATION DATE'] else None
+        creation_date: date = parse_feed_date(exchange_data['CREATION DATE'])
         if self.creation_date != creation_date:
             self.creation_date = creation_date
             changed = True
-        last_update_date: date = date.fromisoformat(str(exchange_data['LAST UPDATE DATE'])) if exchange_data['LAST UPDATE DATE'] else None
+        last_update_date: date = parse_feed_date(exchange_data['LAST UPDATE DATE'])
         if self.last_update_date != last_update_date:
             self.last_update_date = last_update_date
             changed = True
-        last_validation_date: date = date.fromisoformat(str(exchange_data['LAST VALIDATION DATE'])) if exchange_data['LAST VALIDATION DATE'] else None
+        last_validation_date: date = parse_feed_date(exchange_data['LAST VALIDATION DATE'])
         if self.last_validation_date != last_validation_date:
             self.last_validation_date = last_validation_date
             changed = True
-        expiry_date: date = date.fromisoformat(str(exchange_data['EXPIRY DATE'])) if exchange_data['EXPIRY DATE'] else None
+        expiry_date: date = parse_feed_date(exchange_data['EXPIRY DATE'])
         if self.expiry_date != expiry_date:
             self.expiry_date = expiry_date
             changed = True
@@ -516,10 +576,10 @@ class Exchange(CacheableDBObject):
         self.city: str = exchange_data['CITY']
         self.website: str = exchange_data['WEBSITE']
         self.status: str = exchange_data['STATUS']
-        self.creation_date: date = date.fromisoformat(str(exchange_data['CREATION DATE'])) if exchange_data['CREATION DATE'] else None
-        self.last_update_date: date = date.fromisoformat(str(exchange_data['LAST UPDATE DATE'])) if exchange_data['LAST UPDATE DATE'] else None
-        self.last_validation_date: date = date.fromisoformat(str(exchange_data['LAST VALIDATION DATE'])) if exchange_data['LAST VALIDATION DATE'] else None
-        self.expiry_date: date = date.fromisoformat(str(exchange_data['EXPIRY DATE'])) if exchange_data['EXPIRY DATE'] else None
+        self.creation_date: date = parse_feed_date(exchange_data['CREATION DATE'])
+        self.last_update_date: date = parse_feed_date(exchange_data['LAST UPDATE DATE'])
+        self.last_validation_date: date = parse_feed_date(exchange_data['LAST VALIDATION DATE'])
+        self.expiry_date: date = parse_feed_date(exchange_data['EXPIRY DATE'])
         self.comments: str = exchange_data['COMMENTS']
         self.data_date: date = datetime.now()
 
@@ -599,6 +659,22 @@ class FinnHubQuote(DBObject):
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
 
+class FinnHubTradeBar(DBObject):
+    # 1 minute bars aggregated from the Finnhub websocket trade stream
+    __tablename__ = "FinnHubTradeBar"
+    symbol_key: Mapped[int] = mapped_column(Integer)
+    bar_time: Mapped[datetime] = mapped_column(DateTime)
+    open: Mapped[float] = mapped_column(Float)
+    high: Mapped[float] = mapped_column(Float)
+    low: Mapped[float] = mapped_column(Float)
+    close: Mapped[float] = mapped_column(Float)
+    volume: Mapped[float] = mapped_column(Float)
+    trade_count: Mapped[int] = mapped_column(Integer)
+
+    __table_args__ = (
+        UniqueConstraint("symbol_key","bar_time", name="ux_FinnHubTradeBar_symbol_time"),
+    )
+
 class YahooQuote(DBObject):
     __tablename__ = "YahooQuote"
     #id: Mapped[int] = mapped_column(Integer,primary_key=True)
@@ -619,26 +695,41 @@ class YahooQuote(DBObject):
         UniqueConstraint("symbol_key","quote_date", name="ux_YahooQuote_symbol_date"),
     )
 
+    _price_columns: Tuple[str, ...] = ('open', 'high', 'low', 'close', 'adjclose')
+
     @classmethod
-    def parse_data(cls, df: pd.DataFrame) -> List["YahooQuote"]:
-        quotes = []
-        for idx, quote_data in df.iterrows():
-
-            quote_date = quote_data['date'].date()
-            open = quote_data['open']
-            high = quote_data['high']
-            low = quote_data['low']
-            close = quote_data['close']
-            adjclose = quote_data['adjclose']
-            volume = quote_data['volume']
-            
-            quote = cls(quote_date=quote_date, open=open, high=high, low=low, close=close, adjclose=adjclose, volume=volume)
+    def parse_columns(cls, df: pd.DataFrame, symbol_key: int) -> ColumnData:
+        # Converts a yahoo_fin DataFrame into column arrays for BulkWriter.add_columns in one pass
+        rows = df.shape[0]
+        columns: ColumnData = {
+            'id': get_id_array(rows),
+            'symbol_key': np.full(rows, symbol_key, dtype=np.int64),
+            'quote_date': df['date'].to_numpy(dtype='datetime64[D]'),
+        }
+        for col in cls._price_columns:
+            columns[col] = df[col].to_numpy(dtype=np.float64)
+        columns['volume'] = df['volume'].to_numpy(dtype=np.float64)
+        return columns
+
+    @classmethod
+    def parse_data(cls, df: pd.DataFrame, symbol_key: Optional[int] = None) -> List["YahooQuote"]:
+        columns = cls.parse_columns(df, symbol_key if symbol_key is not None else 0)
+        ids = columns['id'].tolist()
+        quote_dates = columns['quote_date'].tolist()
+        prices = [np.where(np.isnan(columns[col]), None, columns[col]).tolist() for col in cls._price_columns]
+        volume = columns['volume']
+        volumes = np.where(np.isnan(volume), None, np.nan_to_num(volume).astype(np.int64)).tolist()
 
+        quotes = []
+        for id, quote_date, open, high, low, close, adjclose, volume in zip(ids, quote_dates, *prices, volumes):
+            quote = cls(quote_date=quote_date, open=open, high=high, low=low, close=close, adjclose=adjclose, volume=volume, id=id)
+            if symbol_key is not None:
+                quote.symbol_key = symbol_key
             quotes.append(quote)
         return quotes
     
-    def __init__(self,quote_date: date, open: float, high: float, low: float, close: float, adjclose: float, volume: int):
-        super().__init__()
+    def __init__(self,quote_date: date, open: float, high: float, low: float, close: float, adjclose: float, volume: int, id: Optional[int] = None):
+        super().__init__(id)
 
         self.quote_date = quote_date
         self.open = open
@@ -674,7 +765,41 @@ class YahooQuote(DBObject):
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
 
-Base.metadata.create_all(engine)
+class JobRun(DBObject):
+    # One run of a resumable job over a planned list of symbols, the plan itself is stored as JobRunItems.
+    # plan_key identifies what was planned (e.g. the quote sweep's update time) so a restart only resumes a matching run
+    __tablename__ = "JobRun"
+    job: Mapped[str] = mapped_column(String(40))
+    plan_key: Mapped[Optional[str]] = mapped_column(String(40))
+    status: Mapped[str] = mapped_column(String(20))
+    planned: Mapped[int] = mapped_column(Integer)
+    completed: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    # Every item before this position is completed or failed
+    cursor_position: Mapped[int] = mapped_column(Integer, default=0)
+    started: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    updated: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    finished: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    __table_args__ = (
+        Index("ix_JobRun_job_status", "job", "status"),
+    )
+
+class JobRunItem(DBObject):
+    # One planned symbol of a JobRun, status is one of the JOB_ITEM_* constants in Checkpoint
+    __tablename__ = "JobRunItem"
+    job_run_key: Mapped[int] = mapped_column(Integer)
+    position: Mapped[int] = mapped_column(Integer)
+    symbol_key: Mapped[int] = mapped_column(Integer)
+    start_date: Mapped[Optional[date]] = mapped_column(Date)
+    status: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[Optional[str]] = mapped_column(String(255))
+
+    __table_args__ = (
+        UniqueConstraint("job_run_key","position", name="ux_JobRunItem_run_position"),
+        Index("ix_JobRunItem_run_symbol", "job_run_key", "symbol_key"),
+    )
+
 """ @cacheinit
 class CompanyProfile:
     #_cache_sql = "SELECT id,uid,hash,update_time FROM Symbol"
@@ -1,64 +1,173 @@
 #import os
 import time
+import asyncio
 import finnhub
 import logging
 #import logging.config
-import traceback
 #import configparser
+import numpy as np
 import pandas as pd
 #import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock, local
 from requests.exceptions import ReadTimeout
 from datetime import date, timedelta, datetime, time as time_
 from typing import Tuple, List, Any, Dict, Optional, Callable, Set, cast
 
-from sqlalchemy import select, func, or_
-#from sqlalchemy.orm import 
+from sqlalchemy import update, case
+from sqlalchemy.orm.attributes import set_committed_value
 
-from Base import Session, API_KEY
+from Base import Session, config, get_engine, get_api_key, BulkWriter, log_cache_stats
 from FinnHubClasses import FinnHubQuote, MarketStatus, StockSymbol
+from Reconcile import Reconciler
+from RateLimiter import TokenBucket
+from Metrics import metrics
+from ResponseCache import cached_response
+from Checkpoint import JobCheckpoint, PlanItem
+from SymbolRegistry import SymbolRecord, symbol_registry
 
 logger = logging.getLogger('FinnHub')
 
-REQ_WAIT_TIME: int = 1000
+RATE_LIMIT_PER_MINUTE: float = config.getfloat("api", "rate_limit_per_minute", fallback=60)
+RATE_LIMIT_BURST: float = config.getfloat("api", "rate_limit_burst", fallback=30)
+RATE_LIMIT_RETRIES: int = 3
+API_URL: str = config.get("api", "api_url", fallback=finnhub.Client.API_URL)
+ASYNC_QUOTES: bool = config.getboolean("api", "async_quotes", fallback=False)
+QUOTE_CONCURRENCY: int = config.getint("api", "quote_concurrency", fallback=4)
+QUOTE_QUEUE_SIZE: int = config.getint("api", "quote_queue_size", fallback=100)
+QUOTE_BATCH_SIZE: int = config.getint("api", "quote_batch_size", fallback=500)
+QUOTE_BATCH_SECONDS: float = config.getfloat("api", "quote_batch_seconds", fallback=30)
+FINNHUB_QUOTE_UPDATE_COLUMNS = ('current_price', 'day_change', 'percent_change', 'high', 'low', 'open', 'previous_close')
+DEFAULT_RETRY_AFTER: float = 60
 #BACKFILL_PERIOD_DAYS: int = 1
 
+# Shared with every other process on this host using the same API key
+finnhub_bucket = TokenBucket('finnhub', RATE_LIMIT_PER_MINUTE/60.0, RATE_LIMIT_BURST)
+
+def _on_response(response, *args, **kwargs) -> None:
+    # Every response, including errors, carries the rate limit headers
+    finnhub_bucket.update_from_headers(response.headers)
+    metrics.inc('api_response_bytes', len(response.content), api='finnhub')
+
 def rate_limit(func: Callable):
     def rate_limited_func(self,*args, **kwargs):
-        if self._finnhub_client is None:
-            logger.debug("Opening new finnhub Client")
-            self._finnhub_client = finnhub.Client(api_key=API_KEY)
-    
-        time_since_last_req = round(time.time() * 1000) - self.__class__._last_req
-        if time_since_last_req < REQ_WAIT_TIME:
-            sleep_time = (REQ_WAIT_TIME - time_since_last_req)/1000.0
-            logger.debug("Sleeping for API rate limit: %d ms" ,sleep_time*1000)
-            time.sleep(sleep_time)
-
         ret = None
-        try:
-            ret = func(self,*args, **kwargs)
-        except (finnhub.FinnhubAPIException, finnhub.FinnhubRequestException, ReadTimeout) as ex:
-            logger.error("FinnHub request failed")
-            logger.error(ex)
-            if isinstance(ex,finnhub.FinnhubAPIException) and ex.status_code==403:
-                logger.error("403 Error encountered for request. Skipping request and continuing")
-            else:
-                except_sleep_time = 1
-                if isinstance(ex,ReadTimeout):
-                    except_sleep_time = 10
-                logger.error("Opening new FinnHub client")
-                self._finnhub_client.close()
-                time.sleep(except_sleep_time)
-                self._finnhub_client = finnhub.Client(api_key=API_KEY)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            finnhub_bucket.acquire()
+            try:
+                with metrics.timer('api_request_seconds', api='finnhub', endpoint=func.__name__):
+                    ret = func(self,*args, **kwargs)
+                break
+            except (finnhub.FinnhubAPIException, finnhub.FinnhubRequestException, ReadTimeout) as ex:
+                logger.error("FinnHub request failed")
+                logger.error(ex)
+                if isinstance(ex,finnhub.FinnhubAPIException) and ex.status_code==403:
+                    logger.error("403 Error encountered for request. Skipping request and continuing")
+                    break
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                if isinstance(ex,finnhub.FinnhubAPIException) and ex.status_code==429:
+                    if 'Retry-After' not in ex.response.headers:
+                        finnhub_bucket.block_for(DEFAULT_RETRY_AFTER)
+                else:
+                    except_sleep_time = 1
+                    if isinstance(ex,ReadTimeout):
+                        except_sleep_time = 10
+                    logger.error("Opening new FinnHub client")
+                    self._close_client()
+                    time.sleep(except_sleep_time)
                 logger.error("retrying request")
-                ret = func(self,*args, **kwargs)
-
-        self.__class__._last_req = round(time.time() * 1000)
 
         return ret
 
     return rate_limited_func
 
+class QuoteBatchWriter:
+    # Buffers FinnHubQuote rows and Symbol.last_finnhub_quote_check updates and writes both in one
+    # transaction once batch_size quotes are pending or max_wait seconds have passed since the last write.
+    # The sweep's checkpoint items are completed in the same transaction
+    _quotes: BulkWriter
+    _checks: Dict[int, datetime]
+    _checkpoint: Optional[JobCheckpoint]
+    _batch_size: int
+    _max_wait: float
+    _last_flush: float
+    _lock: RLock
+
+    def __init__(self, batch_size: int = QUOTE_BATCH_SIZE, max_wait: float = QUOTE_BATCH_SECONDS, checkpoint: Optional[JobCheckpoint] = None):
+        self._quotes = BulkWriter(FinnHubQuote.__table__, FINNHUB_QUOTE_UPDATE_COLUMNS, auto_flush=False)
+        self._checks = {}
+        self._checkpoint = checkpoint
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._last_flush = time.monotonic()
+        self._lock = RLock()
+
+    def add(self, symbol: SymbolRecord | StockSymbol, quote: Optional[FinnHubQuote]) -> None:
+        with self._lock:
+            if quote and (symbol.last_finnhub_quote_check is None or quote.quote_time > symbol.last_finnhub_quote_check):
+                quote.symbol_key = symbol.id
+                self._quotes.add_record({col.name: getattr(quote, col.name) for col in FinnHubQuote.__table__.columns})
+            self._checks[symbol.id] = datetime.now()
+            if len(self._checks) >= self._batch_size or time.monotonic() - self._last_flush >= self._max_wait:
+                try:
+                    self.flush()
+                except Exception as ex:
+                    # The batch stays buffered and is retried by the next flush
+                    logger.error(ex)
+
+    def flush(self) -> None:
+        # Quotes and checks leave the buffers only once their transaction committed, a failed write puts them back
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._checks:
+                return
+            batch = self._quotes.take()
+            checks = self._checks
+            self._checks = {}
+            table = StockSymbol.__table__
+            claimed = None
+            try:
+                with get_engine().begin() as conn:
+                    quotes = self._quotes.write(conn, batch)
+                    conn.execute(update(table)
+                                 .where(table.c.id.in_(list(checks.keys())))
+                                 .values(last_finnhub_quote_check=case(checks, value=table.c.id)))
+                    if self._checkpoint:
+                        claimed = self._checkpoint.complete(conn, checks.keys())
+            except Exception:
+                if claimed:
+                    self._checkpoint.discard(claimed)
+                self._quotes.restore(batch)
+                checks.update(self._checks)
+                self._checks = checks
+                logger.error("Failed to write %d quotes and %d quote checks, keeping them for the next flush", batch[1], len(checks))
+                raise
+            if claimed:
+                self._checkpoint.confirm(claimed)
+            logger.debug("Persisted %d quotes and %d quote checks", quotes, len(checks))
+
+            for id, check_time in checks.items():
+                symbol_registry.advance(id, 'last_finnhub_quote_check', check_time)
+                symbol = StockSymbol._cache.peek('id', id)
+                if symbol:
+                    set_committed_value(symbol, 'last_finnhub_quote_check', check_time)
+
+    def close(self) -> None:
+        # Symbols whose quotes still cannot be written at the end are dropped and recorded as failed
+        with self._lock:
+            try:
+                self.flush()
+            except Exception as ex:
+                self._quotes.take()
+                failed = list(self._checks)
+                self._checks = {}
+                logger.error("Dropped the quotes of %d symbols after the final flush failed: %s", len(failed), ex)
+                if self._checkpoint:
+                    for symbol_key in failed:
+                        self._checkpoint.fail(symbol_key, str(ex))
+            self._quotes.close()
+
 #FinnhubAPIException
 class MarketOpenException(Exception):
     message: str
@@ -72,44 +181,74 @@ class MarketOpenException(Exception):
         return f"{self.message} (Time: {self.cur_time})"
 
 class FinnHubClientWrapper:
-    _last_req: int = 0
-
-    _finnhub_client: Optional[finnhub.Client]
+    # Each thread gets its own finnhub.Client, so a failing request in one fetch worker only replaces that
+    # worker's HTTP session and never closes one another worker is using
+    _clients: local
     _market_status: Optional[MarketStatus]
 
     def __init__(self):
-        self._finnhub_client = None
+        self._clients = local()
         self._market_status = self.market_status()
 
+    @property
+    def _finnhub_client(self) -> finnhub.Client:
+        client = getattr(self._clients, 'client', None)
+        if client is None:
+            logger.debug("Opening new finnhub Client")
+            client = self._clients.client = self._new_client()
+        return client
+
+    def _close_client(self) -> None:
+        # The calling thread's next request opens a new client
+        client = getattr(self._clients, 'client', None)
+        self._clients.client = None
+        if client is not None:
+            client.close()
+
+    @staticmethod
+    def _new_client() -> finnhub.Client:
+        client = finnhub.Client(api_key=get_api_key())
+        client.API_URL = API_URL
+        client._session.hooks['response'].append(_on_response)
+        return client
+
+    @staticmethod
+    def rate_limit_metrics() -> Dict[str, float]:
+        return finnhub_bucket.metrics()
+
+    @cached_response('finnhub_stock_symbols')
     @rate_limit
+    def stock_symbols(self, exchange: str) -> List[Dict[str, Any]]:
+        return self._finnhub_client.stock_symbols(exchange)
+
     def update_stock_symbols(self) -> None:
 
-        stock_symbols = self._finnhub_client.stock_symbols('US')
-        symbols_df = pd.DataFrame(stock_symbols)
-        symbols_df['uid'] = symbols_df['symbol'] + symbols_df['mic']
-        symbols_df.set_index('uid', inplace=True)
-        uids = symbols_df.index.to_list()
-        existing_symbols = cast(Set[StockSymbol],StockSymbol.get_all_from_cache(uids, 'uid'))
-        existing_uids = [existing_symbol.uid for existing_symbol in existing_symbols]
-        new_uids = [uid for uid in uids if uid not in existing_uids]
+        stock_symbols = self.stock_symbols('US')
+        if stock_symbols is None:
+            return
+        with metrics.timer('parse_seconds', source='finnhub_symbols'):
+            symbols_df = pd.DataFrame(stock_symbols)
+            symbols_df['uid'] = symbols_df['symbol'] + symbols_df['mic']
+            symbols_df['finnhub_symbol'] = 1
+            symbols_df.set_index('uid', inplace=True)
+            symbols_df = symbols_df.replace({np.nan: None})
 
-        logger.info(f"Found {len(new_uids)} New Symbols")
-        logger.info(f"Comparing {len(existing_uids)} Existing Symbol")
+            reconciler = Reconciler(StockSymbol)
+            result = reconciler.diff(symbols_df)
+
+        logger.info(f"Found {len(result.new)} New Symbols")
+        logger.info(f"Found {len(result.changed)} Changed Symbols")
 
         with Session() as session:
-            for symbol in existing_symbols:
-                if symbol.compare(symbols_df.loc[symbol.uid]):
-                    session.merge(symbol)
-            session.flush()
+            reconciler.apply_changes(session, result.changed)
 
-            new_symbols = StockSymbol.parse_data(symbols_df.loc[new_uids])
+            new_symbols = StockSymbol.parse_data(result.new)
             session.add_all(new_symbols)
             session.flush()
 
-            no_longer_finnhub_symbols = session.scalars(select(StockSymbol).where(StockSymbol.finnhub_symbol==1, StockSymbol.uid.not_in(uids))).all()
+            no_longer_finnhub_symbols = result.removed.loc[result.removed['finnhub_symbol'] == 1, ['id', 'update_count']].assign(finnhub_symbol=0)
             logger.info(f"Found {len(no_longer_finnhub_symbols)} Symbols that are no longer finnhub symbols")
-            for symbol in no_longer_finnhub_symbols:
-                symbol.finnhub_symbol = 0
+            reconciler.apply_changes(session, no_longer_finnhub_symbols)
             
             session.commit()
 
@@ -119,17 +258,25 @@ class FinnHubClientWrapper:
         status = MarketStatus(status_data)
         return status
     
+    @cached_response('finnhub_quote')
     @rate_limit
-    def get_quote(self, symbol: str) -> FinnHubQuote:
-        quote_data = self._finnhub_client.quote(symbol)
+    def quote(self, symbol: str) -> Dict[str, Any]:
+        return self._finnhub_client.quote(symbol)
+
+    def get_quote(self, symbol: str) -> Optional[FinnHubQuote]:
+        quote_data = self.quote(symbol)
         quote = None
-        if int(quote_data.get("t")) > 0:
+        if quote_data is not None and int(quote_data.get("t")) > 0:
             quote = FinnHubQuote(quote_data)
         return quote
 
-    def update_quotes(self) -> None:
+    @staticmethod
+    def _quote_update_time() -> datetime:
+        return datetime.combine(date.today(), time_(hour=19, minute=0, second=0))
+
+    def _plan_quote_sweep(self) -> List[SymbolRecord]:
         quote_day: date = date.today()
-        update_time = datetime.combine(quote_day, time_(hour=19, minute=0, second=0))
+        update_time = self._quote_update_time()
         current_time = datetime.now().time()
 
         if current_time < update_time.time():
@@ -145,41 +292,115 @@ class FinnHubClientWrapper:
             quote_day = quote_day - timedelta(days=weekday_diff)
             logger.info("Updating quotes for %s instead",quote_day)
         
-        stmt = select(StockSymbol.id)\
-                .where(StockSymbol.finnhub_symbol ==1 )\
-                .where(or_(StockSymbol.last_finnhub_quote_check < update_time,
-                           StockSymbol.last_finnhub_quote_check == None))
-        
-        with Session() as session:
-            res = session.scalars(stmt).all()
-            ids = [id for id in res]
+        # Reloaded per sweep so symbols added by update_stock_symbols are included
+        symbol_registry.load()
+        return [symbol for symbol in symbol_registry
+                if symbol.finnhub_symbol and (symbol.last_finnhub_quote_check is None or symbol.last_finnhub_quote_check < update_time)]
+
+    def refresh_market_status(self) -> MarketStatus:
+        # Market status is re-requested at most once per half hour
+        if not self._market_status.is_valid:
+            self._market_status = self.market_status()
+        return self._market_status
+
+    def _check_market_closed(self) -> None:
+        self.refresh_market_status()
+        if self._market_status.is_open:
+            raise MarketOpenException(self._market_status.last_checked)
+
+    def _begin_quote_sweep(self) -> Tuple[Optional[JobCheckpoint], List[SymbolRecord]]:
+        # A sweep interrupted by a crash or the market opening resumes its stored plan for the same update time
+        def plan() -> List[PlanItem]:
+            return [(symbol.id, None) for symbol in self._plan_quote_sweep()]
+        checkpoint, items = JobCheckpoint.begin('quote_sweep', plan, self._quote_update_time().isoformat())
+        records = symbol_registry.resolve([symbol_key for symbol_key, _ in items])
+        return checkpoint, [records[symbol_key] for symbol_key, _ in items if symbol_key in records]
+
+    def update_quotes(self) -> None:
+        checkpoint, symbols = self._begin_quote_sweep()
+        writer = QuoteBatchWriter(checkpoint=checkpoint)
+        finished = False
 
         try:
-            for id in ids:
-                if not self._market_status.is_valid:
-                    self._market_status = self.market_status()
-                if self._market_status.is_open:
-                    raise MarketOpenException(self._market_status.last_checked)
-                symbol = cast(StockSymbol,StockSymbol.get_from_cache(id,'id'))
+            for symbol in symbols:
+                self._check_market_closed()
                 logger.debug(f"Getting quote for symbol: {symbol.symbol}")
                 quote = cast(FinnHubQuote,self.get_quote(symbol.symbol))
-                with Session() as session:
-                    if quote and (symbol.last_finnhub_quote_check is None or quote.quote_time > symbol.last_finnhub_quote_check):
-                    #if quote and (symbol.last_finnhub_quote_check is None or quote.quote_time > datetime.combine(symbol.last_finnhub_quote_check, datetime.min.time())):
-                        logger.debug(f"Persisting quote for symbol: {symbol.symbol}")
-                        quote.symbol_key = symbol.id
-                        quote.symbol = symbol
-                        # Normally it would be better to collect these quotes and insert them as a batch to prevent excessive inserts
-                        # But we have to wait 1 sec per API call so it doesn't really matter
-                        session.add(quote)
-                        session.flush()
-                        logger.debug(f"Persisted quote for symbol: {symbol.symbol}")
-
-                    logger.debug(f"Updating last check time for symbol: {symbol.symbol}")
-                    symbol = session.merge(symbol)
-                    StockSymbol.add_to_cache(symbol)
-                    symbol.last_finnhub_quote_check = datetime.now()
-                    #symbol.last_finnhub_quote_check = quote_day
-                    session.commit()
+                writer.add(symbol, quote)
+            finished = True
+        except MarketOpenException:
+            logger.error("Market Open, exiting")
+        finally:
+            writer.close()
+        if finished and checkpoint:
+            checkpoint.finish()
+        logger.info("Rate limit metrics: %s", finnhub_bucket.metrics())
+        log_cache_stats()
+
+    def update_quotes_async(self, concurrency: int = QUOTE_CONCURRENCY) -> None:
+        checkpoint, symbols = self._begin_quote_sweep()
+        finished = asyncio.run(self._update_quotes_async(symbols, concurrency, checkpoint))
+        if finished and checkpoint:
+            checkpoint.finish()
+        logger.info("Rate limit metrics: %s", finnhub_bucket.metrics())
+        log_cache_stats()
+
+    async def _update_quotes_async(self, symbols: List[SymbolRecord], concurrency: int, checkpoint: Optional[JobCheckpoint] = None) -> bool:
+        # Keeps up to `concurrency` quote requests in flight (the token bucket still paces them)
+        # and hands results to a single persistence task through a bounded queue
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[Optional[Tuple[SymbolRecord, Optional[FinnHubQuote]]]] = asyncio.Queue(maxsize=QUOTE_QUEUE_SIZE)
+        in_flight = asyncio.Semaphore(concurrency)
+        fetch_pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='FinnHubFetch')
+        persist_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='FinnHubPersist')
+        writer = QuoteBatchWriter(checkpoint=checkpoint)
+        fetches: Set[asyncio.Task] = set()
+        finished = False
+
+        async def fetch(symbol: SymbolRecord) -> None:
+            try:
+                logger.debug(f"Getting quote for symbol: {symbol.symbol}")
+                quote = await loop.run_in_executor(fetch_pool, self.get_quote, symbol.symbol)
+                await queue.put((symbol, quote))
+            except Exception as ex:
+                logger.error(f"Failed to get quote for symbol: {symbol.symbol}")
+                logger.error(ex)
+                if checkpoint:
+                    checkpoint.fail(symbol.id, str(ex))
+            finally:
+                in_flight.release()
+
+        async def persist() -> None:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                symbol, quote = item
+                try:
+                    await loop.run_in_executor(persist_pool, writer.add, symbol, quote)
+                except Exception as ex:
+                    # Failed batch writes are retried by the writer, this only loses the symbol's own quote
+                    logger.error(f"Failed to persist quote for symbol: {symbol.symbol}")
+                    logger.error(ex)
+                    if checkpoint:
+                        checkpoint.fail(symbol.id, str(ex))
+
+        persister = asyncio.create_task(persist())
+        try:
+            for symbol in symbols:
+                await in_flight.acquire()
+                await loop.run_in_executor(fetch_pool, self._check_market_closed)
+                task = asyncio.create_task(fetch(symbol))
+                fetches.add(task)
+                task.add_done_callback(fetches.discard)
+            finished = True
         except MarketOpenException:
-            logger.error("Market Open, exiting")
\ No newline at end of file
+            logger.error("Market Open, exiting")
+        finally:
+            await asyncio.gather(*fetches, return_exceptions=True)
+            await queue.put(None)
+            await persister
+            await loop.run_in_executor(persist_pool, writer.close)
+            fetch_pool.shutdown()
+            persist_pool.shutdown()
+        return finished
@@ -0,0 +1,210 @@
+import json
+import time
+import asyncio
+import logging
+import websockets
+import numpy as np
+from datetime import datetime
+from threading import Lock
+from typing import Dict, List, Tuple, Optional, Set, Iterable
+
+from sqlalchemy import select
+
+from Base import Session, get_api_key, config, BulkWriter, get_id_array
+from FinnHubClasses import FinnHubTradeBar, StockSymbol
+
+logger = logging.getLogger('FinnHub')
+
+STREAM_URL: str = config.get("stream", "url", fallback="wss://ws.finnhub.io")
+STREAM_SYMBOLS: List[str] = [symbol.strip() for symbol in config.get("stream", "symbols", fallback="").split(',') if symbol.strip()]
+FLUSH_INTERVAL: float = config.getfloat("stream", "flush_interval", fallback=5)
+# Seconds after a minute ends before its bar is written, and how long written bars are kept for late trades
+BAR_GRACE: float = config.getfloat("stream", "bar_grace", fallback=5)
+BAR_RETENTION: float = config.getfloat("stream", "bar_retention", fallback=120)
+# Symbols are bare tickers, or TICKER:MIC for a ticker listed on several exchanges
+RECONNECT_WAIT: float = 5
+TRADE_BAR_UPDATE_COLUMNS = ('open', 'high', 'low', 'close', 'volume', 'trade_count')
+
+class TradeBar:
+    __slots__ = ('id', 'open', 'high', 'low', 'close', 'volume', 'trade_count')
+
+    def __init__(self, price: float, volume: float):
+        # The id is assigned when the bar is first collected, off the event loop since allocating ids may hit the DB
+        self.id = None
+        self.open = price
+        self.high = price
+        self.low = price
+        self.close = price
+        self.volume = volume
+        self.trade_count = 1
+
+    def add(self, price: float, volume: float) -> None:
+        self.high = max(self.high, price)
+        self.low = min(self.low, price)
+        self.close = price
+        self.volume += volume
+        self.trade_count += 1
+
+class TradeStreamIngestor:
+    # Subscribes to Finnhub trades for a set of symbols and aggregates them in memory into 1 minute bars.
+    # Closed bars are micro-batched into FinnHubTradeBar every flush_interval seconds; bars stay in memory
+    # for bar_retention seconds so late trades rewrite the whole bar instead of a partial one. Trades for
+    # minutes already evicted, or from before the stream started, are dropped since a new bar would only hold
+    # part of the minute. Trades are aggregated on the event loop, bars are collected and written in the executor
+    _symbol_keys: Dict[str, int]
+    _bars: Dict[Tuple[int, int], TradeBar]
+    _dirty: Set[Tuple[int, int]]
+    _url: str
+    _flush_interval: float
+    _writer: BulkWriter
+    _trades: int
+    _late_trades: int
+    _evicted_minute: int
+    _lock: Lock
+    _collect_lock: Lock
+
+    def __init__(self, symbols: Iterable[StockSymbol], url: str = STREAM_URL, flush_interval: float = FLUSH_INTERVAL):
+        # Trades only carry the ticker, so a stream can hold one symbol per ticker
+        self._symbol_keys = {}
+        for symbol in symbols:
+            if symbol.symbol in self._symbol_keys:
+                raise ValueError(f"Symbol {symbol.symbol} is listed more than once, stream it as TICKER:MIC")
+            self._symbol_keys[symbol.symbol] = symbol.id
+        self._bars = {}
+        self._dirty = set()
+        self._url = url
+        self._flush_interval = flush_interval
+        self._writer = BulkWriter(FinnHubTradeBar.__table__, TRADE_BAR_UPDATE_COLUMNS)
+        self._trades = 0
+        self._late_trades = 0
+        self._evicted_minute = int(time.time() // 60)
+        self._lock = Lock()
+        self._collect_lock = Lock()
+
+    @classmethod
+    def for_tickers(cls, tickers: Iterable[str], **kwargs) -> "TradeStreamIngestor":
+        # Tickers are bare or TICKER:MIC; a bare ticker listed on several exchanges is skipped rather than guessed
+        requested: Dict[str, Optional[str]] = {}
+        for entry in tickers:
+            ticker, _, mic = entry.partition(':')
+            requested[ticker] = mic or None
+        with Session() as session:
+            candidates = session.scalars(select(StockSymbol).where(StockSymbol.finnhub_symbol == 1, StockSymbol.symbol.in_(list(requested)))).all()
+        listings: Dict[str, List[StockSymbol]] = {}
+        for symbol in candidates:
+            listings.setdefault(symbol.symbol, []).append(symbol)
+        symbols = []
+        for ticker, mic in requested.items():
+            matches = [symbol for symbol in listings.get(ticker, ()) if mic is None or symbol.mic == mic]
+            if not matches:
+                logger.warning(f"Symbol {ticker} is not a finnhub symbol, not streaming it")
+            elif len(matches) > 1:
+                logger.warning(f"Symbol {ticker} is listed on {', '.join(sorted(str(symbol.mic) for symbol in matches))}, "
+                               f"configure it as {ticker}:<MIC> to stream it")
+            else:
+                symbols.append(matches[0])
+        return cls(symbols, **kwargs)
+
+    def add_trade(self, ticker: str, price: float, volume: float, trade_time_ms: int) -> None:
+        symbol_key = self._symbol_keys.get(ticker)
+        if symbol_key is None:
+            return
+        key = (symbol_key, trade_time_ms // 60000)
+        with self._lock:
+            bar = self._bars.get(key)
+            if bar is None and key[1] < self._evicted_minute:
+                self._late_trades += 1
+                return
+            if bar is None:
+                self._bars[key] = TradeBar(price, volume)
+            else:
+                bar.add(price, volume)
+            self._dirty.add(key)
+            self._trades += 1
+
+    def handle_message(self, message: str) -> None:
+        data = json.loads(message)
+        message_type = data.get('type')
+        if message_type == 'trade':
+            for trade in data.get('data', ()):
+                self.add_trade(trade['s'], float(trade['p']), float(trade.get('v') or 0), int(trade['t']))
+        elif message_type == 'error':
+            logger.error(f"Trade stream error: {data.get('msg')}")
+
+    def collect_closed_bars(self, now: Optional[float] = None, force: bool = False) -> int:
+        # Moves dirty bars of finished minutes into the writer and drops bars past retention. Ids are
+        # allocated outside the lock so trades keep aggregating meanwhile; bars are only removed here
+        now = time.time() if now is None else now
+        closed_minute = (now - BAR_GRACE) // 60
+        expired_minute = (now - BAR_RETENTION) // 60
+        with self._collect_lock:
+            with self._lock:
+                new_bars = [self._bars[key] for key in self._dirty if (force or key[1] < closed_minute) and self._bars[key].id is None]
+            if new_bars:
+                for bar, id in zip(new_bars, get_id_array(len(new_bars)).tolist()):
+                    bar.id = id
+            with self._lock:
+                ready = [key for key in self._dirty if (force or key[1] < closed_minute) and self._bars[key].id is not None]
+                bars = [self._bars[key] for key in ready]
+                columns = {
+                    'id': np.array([bar.id for bar in bars], dtype=np.int64),
+                    'symbol_key': np.array([key[0] for key in ready], dtype=np.int64),
+                    'bar_time': np.array([datetime.fromtimestamp(key[1] * 60) for key in ready], dtype=object),
+                    'open': np.array([bar.open for bar in bars]),
+                    'high': np.array([bar.high for bar in bars]),
+                    'low': np.array([bar.low for bar in bars]),
+                    'close': np.array([bar.close for bar in bars]),
+                    'volume': np.array([bar.volume for bar in bars]),
+                    'trade_count': np.array([bar.trade_count for bar in bars], dtype=np.int64),
+                }
+                self._dirty.difference_update(ready)
+                for key in [key for key in self._bars if key[1] < expired_minute and key not in self._dirty]:
+                    del self._bars[key]
+                self._evicted_minute = max(self._evicted_minute, int(expired_minute))
+            if ready:
+                self._writer.add_columns(columns)
+        return len(ready)
+
+    def flush(self) -> int:
+        # Blocks on the DB, run in the executor. Rows of a failed write stay in the writer for the next flush
+        self.collect_closed_bars()
+        return self._writer.flush()
+
+    async def _flush_periodically(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await loop.run_in_executor(None, self.flush)
+            except Exception as ex:
+                logger.error("Failed to write trade bars, keeping them for the next flush")
+                logger.error(ex)
+
+    async def _consume(self, stop: asyncio.Event) -> None:
+        async with websockets.connect(f"{self._url}?token={get_api_key()}") as websocket:
+            for ticker in self._symbol_keys:
+                await websocket.send(json.dumps({'type': 'subscribe', 'symbol': ticker}))
+            logger.info(f"Subscribed to trades for {len(self._symbol_keys)} symbols")
+            while not stop.is_set():
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), timeout=self._flush_interval)
+                except asyncio.TimeoutError:
+                    continue
+                self.handle_message(message)
+
+    async def run(self, stop: Optional[asyncio.Event] = None) -> None:
+        stop = stop if stop is not None else asyncio.Event()
+        flusher = asyncio.create_task(self._flush_periodically())
+        try:
+            while not stop.is_set():
+                try:
+                    await self._consume(stop)
+                except (websockets.exceptions.WebSocketException, OSError) as ex:
+                    logger.error("Trade stream connection lost, reconnecting")
+                    logger.error(ex)
+                    await asyncio.sleep(RECONNECT_WAIT)
+        finally:
+            flusher.cancel()
+            self.collect_closed_bars(force=True)
+            self._writer.close()
+            logger.info(f"Processed {self._trades} trades, dropped {self._late_trades} late trades")
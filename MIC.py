@@ -1,18 +1,15 @@
 import os
 import logging
 #import logging.config
-import traceback
 import numpy as np
 import pandas as pd
 import urllib.request
-from typing import cast, Set
-
-from sqlalchemy import select
 
 from FinnHubClasses import Exchange
+from Reconcile import Reconciler
 #from DB import DBConnection
 
-from Base import Session
+from Base import Session, configure_logging
 
 WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
 #logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
@@ -33,21 +30,16 @@ def import_iso10383(filename: str) -> None:
     csvFile = csvFile.replace({np.nan: None})
     mic_df = csvFile.set_index('MIC')
 
-    mics = mic_df.index.to_list()
-    existing_exchanges = cast(Set[Exchange],Exchange.get_all_from_cache(mics, 'mic'))
-    existing_mics = [existing_exchange.mic for existing_exchange in existing_exchanges]
-    new_mics = [mic for mic in mics if mic not in existing_mics]
+    reconciler = Reconciler(Exchange)
+    result = reconciler.diff(mic_df)
 
-    logger.debug(f"Found {len(new_mics)} New Exchanges")
-    logger.debug(f"Comparing {len(existing_mics)} Existing Exchanges")
+    logger.debug(f"Found {len(result.new)} New Exchanges")
+    logger.debug(f"Found {len(result.changed)} Changed Exchanges")
 
     with Session() as session:
-        for exchange in existing_exchanges:
-            if exchange.compare(mic_df.loc[exchange.mic]):
-                session.merge(exchange)
-        session.flush()
+        reconciler.apply_changes(session, result.changed)
 
-        new_exchanges = Exchange.parse_data(mic_df.loc[new_mics])
+        new_exchanges = Exchange.parse_data(result.new)
         session.add_all(new_exchanges)
         session.flush()
 
@@ -99,4 +91,7 @@ def import_iso10383(filename: str) -> None:
 
 #filename = download_iso10383()
 #import_iso10383(filename)
-import_iso10383(ISO10383_PATH)
+if __name__ == '__main__':
+    configure_logging()
+    import_iso10383(ISO10383_PATH)
+
@@ -1,9 +1,6 @@
-import os
-import logging
-import logging.config
+from Base import configure_logging
 from YahooData import backfill_data
 
-WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
-logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
-
-backfill_data()
\ No newline at end of file
+if __name__ == '__main__':
+    configure_logging()
+    backfill_data()
@@ -0,0 +1,250 @@
+import os
+import time
+import random
+import logging
+from threading import Lock, Thread
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('DB')
+
+METRIC_PREFIX = 'marketdata_'
+RESERVOIR_SIZE: int = 2048
+QUANTILES: Tuple[float, ...] = (0.5, 0.95, 0.99)
+
+Labels = Tuple[Tuple[str, str], ...]
+# (name, labels, value, type) where type is 'counter' or 'gauge'
+Sample = Tuple[str, Dict[str, str], float, str]
+
+class Histogram:
+    # Count, sum, min and max of every observation plus a fixed size uniform reservoir sample
+    # (Algorithm R) for the quantile estimates, so memory stays bounded on long runs
+    count: int
+    total: float
+    min: float
+    max: float
+    _reservoir: List[float]
+    _lock: Lock
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self._reservoir = []
+        self._lock = Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+            if len(self._reservoir) < RESERVOIR_SIZE:
+                self._reservoir.append(value)
+            else:
+                slot = random.randrange(self.count)
+                if slot < RESERVOIR_SIZE:
+                    self._reservoir[slot] = value
+
+    def quantiles(self, quantiles: Iterable[float] = QUANTILES) -> Dict[float, float]:
+        with self._lock:
+            values = sorted(self._reservoir)
+        if not values:
+            return {q: 0.0 for q in quantiles}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in quantiles}
+
+    def stats(self) -> Dict[str, float]:
+        quantiles = self.quantiles()
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'p50': quantiles[0.5],
+            'p95': quantiles[0.95],
+            'p99': quantiles[0.99],
+        }
+
+def _errors_name(name: str) -> str:
+    return name.removesuffix('_seconds') + '_errors'
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(labels: Labels | Dict[str, str], **extra: str) -> str:
+    items = list(labels.items() if isinstance(labels, dict) else labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in items) + '}'
+
+class MetricsRegistry:
+    # Process wide histograms and counters keyed by name and labels. Other modules contribute
+    # point in time values (cache and rate limit stats) through collectors called at render time
+    _histograms: Dict[Tuple[str, Labels], Histogram]
+    _counters: Dict[Tuple[str, Labels], float]
+    _collectors: List[Callable[[], Iterable[Sample]]]
+    _lock: Lock
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+        self._lock = Lock()
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        key = (name, _labels(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        # Records the elapsed seconds in the <name> histogram and counts exceptions in the matching <stage>_errors counter
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(_errors_name(name), **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_collector(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def _collect(self) -> List[Sample]:
+        samples: List[Sample] = []
+        for collector in list(self._collectors):
+            try:
+                samples.extend(collector())
+            except Exception as ex:
+                logger.error("Metrics collector %s failed", getattr(collector, '__name__', collector))
+                logger.error(ex)
+        return samples
+
+    def render(self) -> str:
+        # Prometheus text exposition format; histograms are exported as summaries with p50/p95/p99
+        lines: List[str] = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        seen = set()
+        def type_line(name: str, type_: str) -> None:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} {type_}")
+
+        for (name, labels), histogram in histograms:
+            metric = METRIC_PREFIX + name
+            type_line(metric, 'summary')
+            stats = histogram.stats()
+            for q, value in histogram.quantiles().items():
+                lines.append(f"{metric}{_format_labels(labels, quantile=str(q))} {value:.6g}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {stats['sum']:.6g}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {stats['count']}")
+        for (name, labels), value in counters:
+            metric = METRIC_PREFIX + name + '_total'
+            type_line(metric, 'counter')
+            lines.append(f"{metric}{_format_labels(labels)} {value:.6g}")
+        for name, labels, value, type_ in sorted(self._collect(), key=lambda sample: sample[0]):
+            metric = METRIC_PREFIX + name + ('_total' if type_ == 'counter' else '')
+            type_line(metric, type_)
+            lines.append(f"{metric}{_format_labels(labels)} {value:.6g}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        # Written to a temporary file and renamed so a scraper never reads a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def summary(self) -> str:
+        # End of run table of every histogram with its error count
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = dict(self._counters)
+        counter_rows = [(name + _format_labels(labels), value) for (name, labels), value in sorted(counters.items()) if not name.endswith('_errors')]
+        width = max([len('metric')] + [len(name + _format_labels(labels)) for (name, labels), _ in histograms] + [len(label) for label, _ in counter_rows])
+        header = f"{'metric':{width}} {'count':>8} {'errors':>7} {'total s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+        lines = [header, '-' * len(header)]
+        for (name, labels), histogram in histograms:
+            stats = histogram.stats()
+            errors = counters.get((_errors_name(name), labels), 0)
+            lines.append(f"{name + _format_labels(labels):{width}} {stats['count']:8d} {errors:7.0f} {stats['sum']:10.2f} {stats['p50']*1000:9.1f} "
+                         f"{stats['p95']*1000:9.1f} {stats['p99']*1000:9.1f} {stats['max']*1000:9.1f}")
+        for label, value in counter_rows:
+            lines.append(f"{label:{width}} {value:8.0f}")
+        return '\n'.join(lines)
+
+    def log_summary(self) -> None:
+        logger.info("Metrics summary:\n%s", self.summary())
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("Metrics request: " + format, *args)
+
+class MetricsServer:
+    # Serves /metrics from a daemon thread for Prometheus to scrape
+    _server: Optional[ThreadingHTTPServer]
+    _thread: Optional[Thread]
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = ''):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> "MetricsServer":
+        if self._thread is None:
+            self._thread = Thread(target=self._server.serve_forever, name='MetricsServer', daemon=True)
+            self._thread.start()
+            logger.info("Serving metrics on port %d", self.port)
+        return self
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+metrics = MetricsRegistry()
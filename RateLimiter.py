@@ -0,0 +1,155 @@
+import os
+import time
+import fcntl
+import struct
+import logging
+from threading import RLock
+from typing import Dict, Optional, Mapping
+
+from Base import WORKING_DIR
+from Metrics import metrics
+
+logger = logging.getLogger('DB')
+
+STATE_DIR = WORKING_DIR+os.sep+'stage'
+_STATE_FORMAT = 'ddd'
+_STATE_SIZE = struct.calcsize(_STATE_FORMAT)
+
+class TokenBucket:
+    # Token bucket whose state (tokens, last refill, blocked until) lives in a small file under stage/.
+    # Threads are serialized with an RLock and processes on the same host with flock on that file,
+    # so every process using the same bucket name shares one budget
+    name: str
+    rate: float
+    capacity: float
+    _path: str
+    _fd: Optional[int]
+    _lock: RLock
+    _acquired: int
+    _throttled: int
+    _total_wait: float
+    _last_wait: float
+    _tokens: float
+    _blocked_until: float
+
+    def __init__(self, name: str, rate: float, capacity: float, state_dir: str = STATE_DIR):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._path = state_dir+os.sep+name+'.bucket'
+        self._fd = None
+        self._lock = RLock()
+        self._acquired = 0
+        self._throttled = 0
+        self._total_wait = 0.0
+        self._last_wait = 0.0
+        self._tokens = capacity
+        self._blocked_until = 0.0
+
+    def _open(self) -> int:
+        if self._fd is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self._fd
+
+    def _read_state(self, fd: int, now: float):
+        data = os.pread(fd, _STATE_SIZE, 0)
+        if len(data) < _STATE_SIZE:
+            return self.capacity, now, 0.0
+        tokens, last, blocked_until = struct.unpack(_STATE_FORMAT, data)
+        tokens = min(self.capacity, tokens + max(0.0, now - last) * self.rate)
+        return tokens, now, blocked_until
+
+    def _write_state(self, fd: int, tokens: float, last: float, blocked_until: float) -> None:
+        os.pwrite(fd, struct.pack(_STATE_FORMAT, tokens, last, blocked_until), 0)
+        self._tokens = tokens
+        self._blocked_until = blocked_until
+
+    def _update(self, fn) -> float:
+        # Runs fn(tokens, blocked_until, now) -> (tokens, blocked_until, wait) under both locks
+        with self._lock:
+            fd = self._open()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                tokens, last, blocked_until = self._read_state(fd, now)
+                tokens, blocked_until, wait = fn(tokens, blocked_until, now)
+                self._write_state(fd, tokens, last, blocked_until)
+                return wait
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        # Takes tokens if available and returns 0, otherwise returns the seconds to wait before retrying
+        def take(available: float, blocked_until: float, now: float):
+            if blocked_until > now:
+                return available, blocked_until, blocked_until - now
+            if available >= tokens:
+                return available - tokens, blocked_until, 0.0
+            return available, blocked_until, (tokens - available) / self.rate
+        return self._update(take)
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                break
+            logger.debug("Sleeping for %s rate limit: %d ms", self.name, wait*1000)
+            time.sleep(wait)
+            waited += wait
+        with self._lock:
+            self._acquired += 1
+            self._last_wait = waited
+            self._total_wait += waited
+            if waited > 0:
+                self._throttled += 1
+        metrics.observe('rate_limit_wait_seconds', waited, bucket=self.name)
+        return waited
+
+    def block_for(self, seconds: float) -> None:
+        # Drains the bucket and blocks every sharer for the given time, e.g. after a 429
+        logger.warning("%s rate limit exceeded, blocking requests for %.1f s", self.name, seconds)
+        self._update(lambda available, blocked_until, now: (0.0, max(blocked_until, now + seconds), 0.0))
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        # Honours Retry-After and X-Ratelimit-Remaining/X-Ratelimit-Reset headers when the API sends them
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                self.block_for(float(retry_after))
+            except ValueError:
+                logger.warning("Unable to parse Retry-After header: %s", retry_after)
+            return
+
+        remaining = headers.get('X-Ratelimit-Remaining')
+        if remaining is None:
+            return
+        reset = headers.get('X-Ratelimit-Reset')
+        def clamp(available: float, blocked_until: float, now: float):
+            available = min(available, float(remaining))
+            if float(remaining) <= 0 and reset is not None:
+                blocked_until = max(blocked_until, float(reset))
+            return available, blocked_until, 0.0
+        try:
+            self._update(clamp)
+        except ValueError:
+            logger.warning("Unable to parse rate limit headers: %s %s", remaining, reset)
+
+    def metrics(self) -> Dict[str, float]:
+        with self._lock:
+            self._update(lambda available, blocked_until, now: (available, blocked_until, 0.0))
+            return {
+                'tokens': self._tokens,
+                'blocked_for': max(0.0, self._blocked_until - time.time()),
+                'acquired': self._acquired,
+                'throttled': self._throttled,
+                'last_wait': self._last_wait,
+                'total_wait': self._total_wait,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
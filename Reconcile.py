@@ -0,0 +1,143 @@
+import logging
+import numpy as np
+import pandas as pd
+from datetime import date, datetime
+from typing import Dict, List, Type, Optional
+
+from sqlalchemy import select, update, bindparam, Date, DateTime
+from sqlalchemy.orm import Session as SessionType
+from sqlalchemy.orm.attributes import set_committed_value
+
+from Base import Session, CacheableDBObject
+
+logger = logging.getLogger('DB')
+
+class ReconcileResult:
+    new: pd.DataFrame
+    changed: pd.DataFrame
+    removed: pd.DataFrame
+    changed_fields: Dict[str, int]
+
+    def __init__(self, new: pd.DataFrame, changed: pd.DataFrame, removed: pd.DataFrame, changed_fields: Dict[str, int]):
+        self.new = new
+        self.changed = changed
+        self.removed = removed
+        self.changed_fields = changed_fields
+
+def _date_text(value) -> Optional[str]:
+    # YYYYMMDD numbers come back as floats like 20200101.0 once a column has blanks, even after NaN is replaced with None
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool):
+        return str(int(value)) if float(value).is_integer() else str(value)
+    text = str(value).strip()
+    return text or None
+
+def parse_feed_date(value) -> Optional[date]:
+    # Scalar counterpart of parse_feed_dates for feeds parsed row by row
+    text = _date_text(value)
+    if text is None:
+        return None
+    parsed = pd.to_datetime(text, format='ISO8601', errors='coerce')
+    if pd.isna(parsed):
+        raise ValueError(f"{value!r} is not a date")
+    return parsed.date()
+
+def parse_feed_dates(values: pd.Series, name: str) -> pd.Series:
+    # MIC feeds give dates as YYYYMMDD numbers, floats when the column has blanks, or as ISO strings.
+    # A value that does not parse raises instead of silently becoming NULL in the DB
+    text = values.map(_date_text).astype('string')
+    dates = pd.to_datetime(text, format='ISO8601', errors='coerce')
+    invalid = text.notna() & dates.isna()
+    if invalid.any():
+        raise ValueError(f"{invalid.sum()} {name} values are not dates, e.g. {', '.join(text[invalid].unique()[:5])}")
+    dates = dates.dt.date
+    return dates.where(dates.notna(), None).astype(object)
+
+class Reconciler:
+    # Diffs an incoming feed against the current DB state of a CacheableDBObject type.
+    # The type declares _natural_key and _feed_columns (attribute -> feed column) to drive the comparison
+    _type: Type[CacheableDBObject]
+    _natural_key: str
+    _feed_columns: Dict[str, str]
+
+    def __init__(self, type_: Type[CacheableDBObject]):
+        self._type = type_
+        self._natural_key = type_._natural_key
+        self._feed_columns = type_._feed_columns
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self._feed_columns.keys())
+
+    def load_current(self) -> pd.DataFrame:
+        table = self._type.__table__
+        stmt = select(table.c.id, table.c.update_count, table.c[self._natural_key], *[table.c[attr] for attr in self.fields if attr != self._natural_key])
+        with Session() as session:
+            res = session.execute(stmt)
+            current = pd.DataFrame(res.all(), columns=list(res.keys()))
+        return current.set_index(self._natural_key)
+
+    def normalize_feed(self, feed: pd.DataFrame) -> pd.DataFrame:
+        table = self._type.__table__
+        values = feed[list(self._feed_columns.values())].rename(columns={col: attr for attr, col in self._feed_columns.items()})
+        for attr in self.fields:
+            col_type = table.c[attr].type
+            if isinstance(col_type, Date) and not isinstance(col_type, DateTime):
+                values[attr] = parse_feed_dates(values[attr], attr)
+        return values.astype(object).where(values.notna(), None)
+
+    def diff(self, feed: pd.DataFrame, current: Optional[pd.DataFrame] = None) -> ReconcileResult:
+        feed = feed[~feed.index.duplicated(keep='first')]
+        if current is None:
+            current = self.load_current()
+
+        feed_values = self.normalize_feed(feed)
+        merged = current.join(feed_values, how='inner', rsuffix='_feed')
+
+        changed_mask = np.zeros(merged.shape[0], dtype=bool)
+        changed_fields: Dict[str, int] = {}
+        for attr in self.fields:
+            if attr == self._natural_key:
+                continue
+            existing = merged[attr]
+            incoming = merged[attr + '_feed']
+            field_changed = ~((existing == incoming) | (existing.isna() & incoming.isna())).to_numpy()
+            if field_changed.any():
+                changed_fields[attr] = int(field_changed.sum())
+            changed_mask |= field_changed
+
+        changed = merged.loc[changed_mask, ['id', 'update_count'] + [attr + '_feed' for attr in self.fields if attr != self._natural_key]]
+        changed = changed.rename(columns={attr + '_feed': attr for attr in self.fields})
+        new = feed.loc[~feed.index.isin(current.index)]
+        removed = current.loc[~current.index.isin(feed.index)]
+
+        for attr, count in changed_fields.items():
+            logger.info(f"Updated {attr} for {count} {self._type.__name__} rows")
+
+        return ReconcileResult(new, changed, removed, changed_fields)
+
+    def apply_changes(self, session: SessionType, changed: pd.DataFrame) -> int:
+        # Writes changed rows with a single executemany UPDATE and keeps cached objects in step
+        if changed.shape[0] == 0:
+            return 0
+        table = self._type.__table__
+        fields = [attr for attr in changed.columns if attr not in ('id', 'update_count')]
+        update_stamp = datetime.now()
+        stmt = update(table)\
+                .where(table.c.id == bindparam('b_id'))\
+                .values({attr: bindparam('b_' + attr) for attr in fields})\
+                .values(update_count=table.c.update_count + 1, update_stamp=update_stamp)
+        records = changed.astype(object).where(changed.notna(), None).to_dict('records')
+        session.execute(stmt, [{'b_' + key: value for key, value in record.items()} for record in records])
+
+        for record in records:
+            cache_object = self._type._cache.peek('id', record['id'])
+            if cache_object:
+                for attr in fields:
+                    set_committed_value(cache_object, attr, record[attr])
+                set_committed_value(cache_object, 'update_count', record['update_count'] + 1)
+                set_committed_value(cache_object, 'update_stamp', update_stamp)
+                # Re-index, the changed fields may be cache keys
+                self._type._cache.put(cache_object)
+        return len(records)
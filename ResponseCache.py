@@ -0,0 +1,200 @@
+import os
+import time
+import pickle
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from threading import RLock
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from Base import WORKING_DIR, config
+from Metrics import metrics, Sample
+
+logger = logging.getLogger('DB')
+
+HTTP_CACHE_ENABLED: bool = config.getboolean("http_cache", "enabled", fallback=True)
+HTTP_CACHE_BYPASS: bool = config.getboolean("http_cache", "bypass", fallback=False)
+HTTP_CACHE_DIR: str = config.get("http_cache", "dir", fallback=WORKING_DIR+os.sep+'stage'+os.sep+'http_cache')
+HTTP_CACHE_MAX_BYTES: int = config.getint("http_cache", "max_mb", fallback=512) * 2**20
+# Seconds a response stays valid, overridden with [http_cache] <endpoint>_ttl; 0 disables caching for the endpoint.
+# Yahoo bars before today are kept without expiry under yahoo_history_closed, the TTL covers the open ended rest
+DEFAULT_TTLS: Dict[str, float] = {
+    'finnhub_stock_symbols': 24*3600,
+    'finnhub_quote': 1800,
+    'yahoo_history': 24*3600,
+}
+
+def next_midnight() -> float:
+    # Open ended history requests include today's bars, so they are only complete for the day they were fetched
+    tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+    return tomorrow.timestamp()
+
+class ResponseCache:
+    # Content addressed on-disk cache of decoded API responses. The file name is the sha256 of the
+    # endpoint and request arguments, the file holds (expires, response) pickled. Files are
+    # evicted least recently used first once the directory grows beyond max_bytes; every process
+    # on the host shares the directory, so a missing file is always treated as a miss
+    directory: str
+    max_bytes: int
+    enabled: bool
+    bypass: bool
+    _index: Optional[OrderedDict]
+    _size: int
+    _lock: RLock
+
+    def __init__(self, directory: str = HTTP_CACHE_DIR, max_bytes: int = HTTP_CACHE_MAX_BYTES,
+                 enabled: bool = HTTP_CACHE_ENABLED, bypass: bool = HTTP_CACHE_BYPASS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.bypass = bypass
+        self._index = None
+        self._size = 0
+        self._lock = RLock()
+
+    @staticmethod
+    def ttl(endpoint: str) -> float:
+        return config.getfloat("http_cache", endpoint+"_ttl", fallback=DEFAULT_TTLS.get(endpoint, 0))
+
+    @staticmethod
+    def key(endpoint: str, *request) -> str:
+        return hashlib.sha256(repr((endpoint, request)).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return self.directory+os.sep+key[:2]+os.sep+key+'.pkl'
+
+    def _load_index(self) -> OrderedDict:
+        # Built lazily from the directory, oldest access first
+        if self._index is None:
+            files = []
+            if os.path.isdir(self.directory):
+                for root, _, names in os.walk(self.directory):
+                    for name in names:
+                        if name.endswith('.pkl'):
+                            path = root+os.sep+name
+                            try:
+                                stat = os.stat(path)
+                            except FileNotFoundError:
+                                continue
+                            files.append((stat.st_mtime, path, stat.st_size))
+            files.sort()
+            self._index = OrderedDict((path, size) for _, path, size in files)
+            self._size = sum(self._index.values())
+        return self._index
+
+    def _discard(self, path: str) -> None:
+        with self._lock:
+            self._size -= self._load_index().pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, endpoint: str, key: str) -> Tuple[bool, Any]:
+        if not self.enabled or self.bypass:
+            return False, None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, response = pickle.load(f)
+        except FileNotFoundError:
+            metrics.inc('http_cache_misses', endpoint=endpoint)
+            return False, None
+        except Exception as error:
+            logger.warning("Unable to read cached response %s: %s", path, error)
+            self._discard(path)
+            metrics.inc('http_cache_misses', endpoint=endpoint)
+            return False, None
+        if expires <= time.time():
+            self._discard(path)
+            metrics.inc('http_cache_expirations', endpoint=endpoint)
+            metrics.inc('http_cache_misses', endpoint=endpoint)
+            return False, None
+        with self._lock:
+            index = self._load_index()
+            if path in index:
+                index.move_to_end(path)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        metrics.inc('http_cache_hits', endpoint=endpoint)
+        return True, response
+
+    def put(self, endpoint: str, key: str, response: Any, expires: float) -> None:
+        if not self.enabled:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((expires, response), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        metrics.inc('http_cache_bytes_written', size, endpoint=endpoint)
+        with self._lock:
+            index = self._load_index()
+            self._size += size - index.pop(path, 0)
+            index[path] = size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and len(self._index) > 1:
+            path, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            metrics.inc('http_cache_evictions')
+
+    def fetch(self, endpoint: str, request: Tuple, fn: Callable[[], Any], expires_at: Optional[float] = None) -> Any:
+        # Returns the cached response for the request or calls fn and caches what it returns.
+        # None is never cached, fn returns it for requests that were skipped (e.g. a 403)
+        ttl = self.ttl(endpoint)
+        if not self.enabled or ttl <= 0:
+            return fn()
+        key = self.key(endpoint, *request)
+        hit, response = self.get(endpoint, key)
+        if hit:
+            return response
+        response = fn()
+        if response is not None:
+            expires = time.time() + ttl
+            if expires_at is not None:
+                expires = min(expires, expires_at)
+            try:
+                self.put(endpoint, key, response, expires)
+            except OSError as error:
+                logger.warning("Unable to cache %s response: %s", endpoint, error)
+        return response
+
+    def clear(self) -> None:
+        with self._lock:
+            for path in list(self._load_index()):
+                self._discard(path)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            index = self._load_index()
+            return {'files': len(index), 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+response_cache = ResponseCache()
+
+def _response_cache_metrics() -> Iterator[Sample]:
+    if response_cache.enabled:
+        stats = response_cache.stats()
+        yield 'http_cache_files', {}, stats['files'], 'gauge'
+        yield 'http_cache_bytes', {}, stats['bytes'], 'gauge'
+
+metrics.register_collector(_response_cache_metrics)
+
+def cached_response(endpoint: str):
+    # Caches the decorated method's return value by its arguments; goes outside rate_limit so hits
+    # do not spend rate budget
+    def decorator(func: Callable):
+        def cached_func(self, *args, **kwargs):
+            return response_cache.fetch(endpoint, (args, tuple(sorted(kwargs.items()))), lambda: func(self, *args, **kwargs))
+        return cached_func
+    return decorator
@@ -0,0 +1,105 @@
+import sys
+import time
+import logging
+from datetime import date, datetime
+from typing import Dict, List, Optional, Iterator
+
+from sqlalchemy import select
+
+from Base import Session
+from FinnHubClasses import StockSymbol
+from Metrics import metrics, Sample
+
+logger = logging.getLogger('DB')
+
+class SymbolRecord:
+    # Read-mostly projection of a Symbol row; only the quote check watermarks are advanced in place
+    __slots__ = ('id', 'symbol', 'mic', 'uid', 'exchange_key', 'finnhub_symbol', 'last_finnhub_quote_check', 'last_yahoo_quote_check')
+
+    def __init__(self, id: int, symbol: str, mic: Optional[str], uid: Optional[str], exchange_key: int, finnhub_symbol: bool,
+                 last_finnhub_quote_check: Optional[datetime], last_yahoo_quote_check: Optional[date]):
+        self.id = id
+        self.symbol = sys.intern(symbol)
+        self.mic = sys.intern(mic) if mic is not None else None
+        self.uid = sys.intern(uid) if uid is not None else None
+        self.exchange_key = exchange_key
+        self.finnhub_symbol = bool(finnhub_symbol)
+        self.last_finnhub_quote_check = last_finnhub_quote_check
+        self.last_yahoo_quote_check = last_yahoo_quote_check
+
+    def __repr__(self) -> str:
+        return f"SymbolRecord({self.id}, {self.uid})"
+
+class SymbolRegistry:
+    # Compact registry of every Symbol row for planning quote sweeps and backfills in long running processes.
+    # It is built with one narrow Core query and holds SymbolRecords by id; the writers advance the quote
+    # check watermarks after each commit so later plans need no reload
+    _by_id: Dict[int, SymbolRecord]
+    _loaded_at: Optional[float]
+
+    def __init__(self):
+        self._by_id = {}
+        self._loaded_at = None
+
+    def load(self) -> int:
+        # Rebuilds the index and swaps it in whole, so readers never see a partial registry
+        table = StockSymbol.__table__
+        stmt = select(table.c.id, table.c.symbol, table.c.mic, table.c.uid, table.c.exchange_key, table.c.finnhub_symbol,
+                      table.c.last_finnhub_quote_check, table.c.last_yahoo_quote_check)
+        start = time.perf_counter()
+        by_id: Dict[int, SymbolRecord] = {}
+        with Session() as session:
+            for row in session.execute(stmt.execution_options(yield_per=10000)):
+                record = SymbolRecord(*row)
+                by_id[record.id] = record
+        self._by_id = by_id
+        self._loaded_at = time.monotonic()
+        logger.info("Loaded %d symbols into the symbol registry in %.3f s", len(by_id), time.perf_counter() - start)
+        return len(by_id)
+
+    def ensure_loaded(self) -> None:
+        if self._loaded_at is None:
+            self.load()
+
+    @property
+    def loaded_at(self) -> Optional[float]:
+        return self._loaded_at
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[SymbolRecord]:
+        return iter(list(self._by_id.values()))
+
+    def get(self, id: int) -> Optional[SymbolRecord]:
+        return self._by_id.get(id)
+
+    def resolve(self, ids: List[int]) -> Dict[int, SymbolRecord]:
+        # Records for a stored plan; reloads once if the registry predates any of the planned symbols
+        self.ensure_loaded()
+        if any(id not in self._by_id for id in ids):
+            self.load()
+        return {id: self._by_id[id] for id in ids if id in self._by_id}
+
+    def advance(self, id: int, attr: str, value: date | datetime) -> None:
+        # Moves a quote check watermark forward after it has been written to the DB
+        record = self._by_id.get(id)
+        if record is not None and value is not None:
+            current = getattr(record, attr)
+            if current is None or current < value:
+                setattr(record, attr, value)
+
+    def estimated_bytes(self) -> int:
+        size = sys.getsizeof(self._by_id)
+        for record in self._by_id.values():
+            size += sys.getsizeof(record)
+        return size
+
+symbol_registry = SymbolRegistry()
+
+def _symbol_registry_metrics() -> Iterator[Sample]:
+    if symbol_registry.loaded_at is not None:
+        yield 'symbol_registry_symbols', {}, len(symbol_registry), 'gauge'
+        yield 'symbol_registry_bytes', {}, symbol_registry.estimated_bytes(), 'gauge'
+
+metrics.register_collector(_symbol_registry_metrics)
@@ -1,101 +1,299 @@
 import time
 import traceback
 import pandas as pd
+from queue import Queue
+from threading import Thread
 from datetime import date, timedelta
-#import concurrent.futures
 from yahoo_fin.stock_info import get_data
 #from DB import DBConnection
 import logging
-from typing import Dict
+from typing import Dict, List, Tuple, Optional
 
-from sqlalchemy import select, func
+from sqlalchemy import select, update, or_, bindparam, Connection
 
-from Base import Session
+from Base import Session, BulkWriter, ColumnData, config, get_engine, configure_logging, export_metrics
 from FinnHubClasses import YahooQuote, StockSymbol
+from RateLimiter import TokenBucket
+from Metrics import metrics
+from ResponseCache import response_cache, next_midnight
+from SymbolRegistry import SymbolRecord, symbol_registry
+from Checkpoint import JobCheckpoint, PlanItem, ClaimedMarks
 
 logger = logging.getLogger('Yahoo')
 
 REQ_WAIT_TIME: int = 1000
 BACKFILL_PERIOD_DAYS: int = 1
-PERSIST_THREADS: int = 3
-#GET_DATES_QUERY = "SELECT s.id,s.symbol,max(yhd.quote_date) FROM Symbol s LEFT OUTER JOIN YahooHistoricalData yhd on s.id = yhd.symbol_key GROUP BY s.id,s.symbol"
-#INSERT_SQL = "INSERT INTO YahooHistoricalData(id,symbol_key,quote_date,open,high,low,close,adjclose,volume) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)"
-#persist_pool =  concurrent.futures.ThreadPoolExecutor(max_workers=PERSIST_THREADS, thread_name_prefix='YahooDataPersister')
+PERSIST_THREADS: int = config.getint("yahoo", "persist_threads", fallback=3)
+QUEUE_SIZE: int = config.getint("yahoo", "queue_size", fallback=50)
+RATE_LIMIT_PER_MINUTE: float = config.getfloat("yahoo", "rate_limit_per_minute", fallback=60000/REQ_WAIT_TIME)
+BULK_INSERT: bool = config.getboolean("yahoo", "bulk_insert", fallback=True)
+YAHOO_QUOTE_UPDATE_COLUMNS = ('open', 'high', 'low', 'close', 'adjclose', 'volume')
 
-QUOTE_DATES_STMT = select(StockSymbol,func.max(YahooQuote.quote_date))\
-                    .outerjoin(StockSymbol.yahoo_quotes)\
-                    .group_by(StockSymbol)
-#.outerjoin(StockSymbol.yahoo_quotes)\
-#.outerjoin(YahooQuote, StockSymbol.id == YahooQuote.symbol_key)\
+WATERMARK_STMT = update(StockSymbol.__table__)\
+                    .where(StockSymbol.__table__.c.id == bindparam('b_id'))\
+                    .where(or_(StockSymbol.__table__.c.last_yahoo_quote_check == None,
+                               StockSymbol.__table__.c.last_yahoo_quote_check < bindparam('b_last_quote')))\
+                    .values(last_yahoo_quote_check=bindparam('b_last_quote'))
 
-last_req: int = round(time.time() * 1000)
+yahoo_bucket = TokenBucket('yahoo', RATE_LIMIT_PER_MINUTE/60.0, 1)
 
 def get_yahoo_data_for_symbol(symbol: str, start_date: date = None):
-    global last_req
+    # Bars before today are final and cached without expiry under the request's symbol and start date,
+    # together with the first day they do not cover. Only the bars from that day on are requested again,
+    # and those are cached until midnight like any open ended request
     start_date_str = start_date.strftime("%m/%d/%Y") if start_date else None
-    time_since_last_req = round(time.time() * 1000) - last_req 
-    if time_since_last_req < REQ_WAIT_TIME:
-        sleep_time = (REQ_WAIT_TIME - time_since_last_req)/1000.0
-        logger.debug("Sleeping for API rate limit: %d ms" ,sleep_time*1000)
-        time.sleep(sleep_time)
+    if not response_cache.enabled or response_cache.ttl('yahoo_history') <= 0:
+        return _get_data(symbol, start_date_str)
+    closed_key = response_cache.key('yahoo_history_closed', symbol, start_date_str)
+    hit, closed = response_cache.get('yahoo_history_closed', closed_key)
+    open_from, history = closed if hit else (start_date, None)
+    open_from_str = open_from.strftime("%m/%d/%Y") if open_from else None
+    recent = response_cache.fetch('yahoo_history', (symbol, open_from_str), lambda: _get_data(symbol, open_from_str), expires_at=next_midnight())
+    if history is None or recent is None:
+        yahoo_data = recent if recent is not None else history
+    else:
+        yahoo_data = pd.concat([history, recent], ignore_index=True)
+    if yahoo_data is not None and recent is not None:
+        today = date.today()
+        if open_from is None or open_from < today:
+            before_today = yahoo_data['date'] < pd.Timestamp(today)
+            try:
+                response_cache.put('yahoo_history_closed', closed_key, (today, yahoo_data[before_today]), float('inf'))
+                # A rerun today then finds the rest of the bars under the request for today
+                response_cache.put('yahoo_history', response_cache.key('yahoo_history', symbol, today.strftime("%m/%d/%Y")),
+                                   yahoo_data[~before_today].reset_index(drop=True), next_midnight())
+            except OSError as error:
+                logger.warning("Unable to cache yahoo history for %s: %s", symbol, error)
+    return yahoo_data
+
+def _get_data(symbol: str, start_date_str: Optional[str]) -> Optional[pd.DataFrame]:
+    yahoo_bucket.acquire()
     logger.debug("Getting data for %s starting at %s", symbol,start_date_str)
     try:
-        yahoo_data = get_data(symbol,start_date = start_date_str, index_as_date=False)
+        with metrics.timer('api_request_seconds', api='yahoo', endpoint='get_data'):
+            yahoo_data = get_data(symbol,start_date = start_date_str, index_as_date=False)
+        # yahoo_fin does not expose the HTTP response, the decoded frame size stands in for it
+        metrics.inc('api_response_bytes', int(yahoo_data.memory_usage(index=True).sum()), api='yahoo')
     except Exception as error:
         logger.error(error)
         yahoo_data = None
-    last_req = round(time.time() * 1000)
 
     return yahoo_data
 
-def backfill_data():
-    #conn = DBConnection.getConnection()
-    #res = conn.executeQuery(GET_DATES_QUERY)
-    symbol_date_map: Dict[StockSymbol,date] = {}
+def plan_backfill() -> List[Tuple[SymbolRecord, Optional[date]]]:
+    # Symbol.last_yahoo_quote_check is the watermark, maintained with every quote write. The due symbols are
+    # selected through its index and resolved to registry records
+    cutoff = date.today() - timedelta(days=BACKFILL_PERIOD_DAYS)
+    table = StockSymbol.__table__
     with Session() as session:
-        res = session.execute(QUOTE_DATES_STMT).all()
-        for symbol, last_date in res:
-            symbol_date_map[symbol] = last_date
-    for symbol,last_date in symbol_date_map.items():
-        if last_date is None or (date.today() - last_date).days >= BACKFILL_PERIOD_DAYS:
-            if last_date:
-                last_date = last_date + timedelta(days=1)
+        due = session.execute(select(table.c.id, table.c.last_yahoo_quote_check)
+                              .where(or_(table.c.last_yahoo_quote_check == None, table.c.last_yahoo_quote_check <= cutoff))
+                              .order_by(table.c.id)).all()
+    records = symbol_registry.resolve([row.id for row in due])
+    return [(records[row.id], row.last_yahoo_quote_check + timedelta(days=1) if row.last_yahoo_quote_check else None)
+            for row in due if row.id in records]
+
+def update_watermarks(conn: Connection, watermarks: Dict[int, date], checkpoint: Optional[JobCheckpoint] = None) -> Optional[ClaimedMarks]:
+    # Runs in the quotes' transaction, advance_watermarks and checkpoint.confirm once it committed
+    if watermarks:
+        conn.execute(WATERMARK_STMT, [{'b_id': symbol_key, 'b_last_quote': last_quote} for symbol_key, last_quote in watermarks.items()])
+    if checkpoint:
+        return checkpoint.complete(conn, watermarks.keys())
+    return None
+
+def advance_watermarks(watermarks: Dict[int, date]) -> None:
+    for symbol_key, last_quote in watermarks.items():
+        symbol_registry.advance(symbol_key, 'last_yahoo_quote_check', last_quote)
+
+class YahooQuoteWriter(BulkWriter):
+    # BulkWriter that advances Symbol.last_yahoo_quote_check and completes the backfill's checkpoint
+    # items in the same transaction as the quotes
+    _watermarks: Dict[int, date]
+    _checkpoint: Optional[JobCheckpoint]
+
+    def __init__(self, checkpoint: Optional[JobCheckpoint] = None):
+        super().__init__(YahooQuote.__table__, YAHOO_QUOTE_UPDATE_COLUMNS)
+        self._watermarks = {}
+        self._checkpoint = checkpoint
+
+    def _add_watermark(self, symbol_key: int, last_quote: date) -> None:
+        if symbol_key not in self._watermarks or self._watermarks[symbol_key] < last_quote:
+            self._watermarks[symbol_key] = last_quote
+
+    def add_columns(self, columns: ColumnData) -> None:
+        if len(columns['quote_date']) == 0:
+            return
+        with self._lock:
+            self._add_watermark(int(columns['symbol_key'][0]), columns['quote_date'].max().astype('datetime64[D]').item())
+            super().add_columns(columns)
+
+    def flush(self) -> int:
+        # Always its own transaction. Quotes and watermarks leave the buffers only once it committed; a failed
+        # write keeps them, including the rows of symbols added by other callers, for the next flush
+        with self._lock:
+            if self.pending_rows == 0 and not self._watermarks:
+                return 0
+            batch = self.take()
+            watermarks = self._watermarks
+            self._watermarks = {}
+            claimed = None
+            try:
+                with get_engine().begin() as conn:
+                    rows = self.write(conn, batch)
+                    claimed = update_watermarks(conn, watermarks, self._checkpoint)
+            except Exception:
+                if claimed:
+                    self._checkpoint.discard(claimed)
+                self.restore(batch)
+                for symbol_key, last_quote in watermarks.items():
+                    self._add_watermark(symbol_key, last_quote)
+                logger.error("Failed to write %d quotes for %d symbols, keeping them for the next flush", batch[1], len(watermarks))
+                raise
+            if claimed:
+                self._checkpoint.confirm(claimed)
+            advance_watermarks(watermarks)
+            return rows
+
+    def close(self) -> None:
+        # Symbols whose quotes still cannot be written at the end are dropped and recorded as failed
+        try:
+            super().close()
+        except Exception as error:
+            with self._lock:
+                self.take()
+                failed = list(self._watermarks)
+                self._watermarks = {}
+            logger.error("Dropped the quotes of %d symbols after the final flush failed: %s", len(failed), error)
+            if self._checkpoint:
+                for symbol_key in failed:
+                    self._checkpoint.fail(symbol_key, str(error))
+
+def fetch_stage(plan: List[Tuple[SymbolRecord, Optional[date]]], parse_queue: Queue, checkpoint: Optional[JobCheckpoint] = None) -> None:
+    # Runs at the Yahoo rate; everything downstream happens on other threads
+    try:
+        for symbol, start_date in plan:
             logger.info("Getting data for symbol: %s", symbol.symbol)
-            yahoo_data = get_yahoo_data_for_symbol(symbol.symbol,last_date)
-            if yahoo_data is None:
-                continue
-            if last_date:
-                yahoo_data = yahoo_data.loc[yahoo_data['date']>=pd.Timestamp(last_date)]
-            rows_size = yahoo_data.shape[0]
-            if rows_size == 0:
-                logger.info("No new data for: %s", symbol.symbol)
-                continue
-            
-            quotes = YahooQuote.parse_quotes(yahoo_data,symbol)
-            with Session() as session:
-                logger.info("Persisting %d quotes for symbol %s",len(quotes),symbol.symbol)
-                session.add_all(quotes)
-                session.commit()
-
-            """ new_ids = DBConnection.get_ids(rows_size)
-            yahoo_data.drop(labels='ticker',axis=1, inplace=True)
-            yahoo_data = yahoo_data.astype(object).where(pd.notnull(yahoo_data), None)
-            yahoo_data.insert(0,'id',new_ids, allow_duplicates=False)
-            yahoo_data.insert(1,'symbol_key',symbol_key)
-            #logger.debug(yahoo_data.head)
-            persist_pool.submit(persist_yahoo_data,yahoo_data.to_numpy().tolist()) """
-
-""" def persist_yahoo_data(data):
-    conn = None
+            yahoo_data = get_yahoo_data_for_symbol(symbol.symbol,start_date)
+            if yahoo_data is not None:
+                parse_queue.put((symbol, start_date, yahoo_data))
+            elif checkpoint:
+                checkpoint.fail(symbol.id, "No data returned")
+    finally:
+        parse_queue.put(None)
+
+def parse_stage(parse_queue: Queue, persist_queue: Queue, persist_threads: int, checkpoint: Optional[JobCheckpoint] = None) -> None:
     try:
-        logger.debug("Persisting Yahoo batch of %d rows" , len(data))
-        conn = DBConnection.getConnection()
-        conn.executemany(INSERT_SQL,data)
-        conn.commit()
-    except Exception as error:
-        logger.error(error)
-        traceback.print_exc()
-        if conn is not None:
-            conn.rollback() """
+        while True:
+            item = parse_queue.get()
+            if item is None:
+                break
+            symbol, start_date, yahoo_data = item
+            try:
+                with metrics.timer('parse_seconds', source='yahoo'):
+                    if start_date:
+                        yahoo_data = yahoo_data.loc[yahoo_data['date']>=pd.Timestamp(start_date)]
+                    rows_size = yahoo_data.shape[0]
+                    if rows_size == 0:
+                        logger.info("No new data for: %s", symbol.symbol)
+                        if checkpoint:
+                            checkpoint.done(symbol.id)
+                        continue
+                    if BULK_INSERT:
+                        data = YahooQuote.parse_columns(yahoo_data,symbol.id)
+                    else:
+                        data = YahooQuote.parse_data(yahoo_data,symbol.id)
+                logger.info("Queueing %d quotes for symbol %s",rows_size,symbol.symbol)
+                persist_queue.put((symbol, data))
+            except Exception as error:
+                logger.error("Failed to parse data for symbol: %s", symbol.symbol)
+                logger.error(error)
+                traceback.print_exc()
+                if checkpoint:
+                    checkpoint.fail(symbol.id, str(error))
+    finally:
+        for _ in range(persist_threads):
+            persist_queue.put(None)
+
+def persist_stage(persist_queue: Queue, checkpoint: Optional[JobCheckpoint] = None) -> None:
+    # Each worker owns its writer/session so DB latency only blocks this worker
+    writer = YahooQuoteWriter(checkpoint) if BULK_INSERT else None
+    orm_rows = 0
+    orm_time = 0.0
+    try:
+        while True:
+            item = persist_queue.get()
+            if item is None:
+                break
+            symbol, data = item
+            try:
+                if writer:
+                    writer.add_columns(data)
+                else:
+                    start = time.perf_counter()
+                    claimed = None
+                    try:
+                        with Session() as session:
+                            logger.info("Persisting %d quotes for symbol %s",len(data),symbol.symbol)
+                            session.add_all(data)
+                            session.flush()
+                            watermarks = {symbol.id: max(quote.quote_date for quote in data)}
+                            claimed = update_watermarks(session.connection(), watermarks, checkpoint)
+                            session.commit()
+                    except Exception:
+                        if claimed:
+                            checkpoint.discard(claimed)
+                        raise
+                    if claimed:
+                        checkpoint.confirm(claimed)
+                    advance_watermarks(watermarks)
+                    orm_rows += len(data)
+                    orm_time += time.perf_counter() - start
+            except Exception as error:
+                logger.error("Failed to persist data for symbol: %s", symbol.symbol)
+                logger.error(error)
+                traceback.print_exc()
+                # The writer keeps a failed batch and retries it, only the ORM path loses the symbol's quotes here
+                if checkpoint and not writer:
+                    checkpoint.fail(symbol.id, str(error))
+    finally:
+        if writer:
+            writer.close()
+        elif orm_time > 0:
+            logger.info("Persisted %d quotes through the ORM at %.0f rows/sec", orm_rows, orm_rows/orm_time)
+
+def begin_backfill() -> Tuple[Optional[JobCheckpoint], List[Tuple[SymbolRecord, Optional[date]]]]:
+    # Resumes an interrupted backfill from its stored plan instead of planning a new one
+    def plan() -> List[PlanItem]:
+        return [(symbol.id, start_date) for symbol, start_date in plan_backfill()]
+    checkpoint, items = JobCheckpoint.begin('yahoo_backfill', plan)
+    records = symbol_registry.resolve([symbol_key for symbol_key, _ in items])
+    return checkpoint, [(records[symbol_key], start_date) for symbol_key, start_date in items if symbol_key in records]
+
+def backfill_data(persist_threads: int = PERSIST_THREADS):
+    # fetch -> parse -> persist pipeline connected by bounded queues
+    checkpoint, plan = begin_backfill()
+    logger.info("Backfilling %d symbols with %d persist threads", len(plan), persist_threads)
+    parse_queue: Queue = Queue(maxsize=QUEUE_SIZE)
+    persist_queue: Queue = Queue(maxsize=QUEUE_SIZE)
+
+    parser = Thread(target=parse_stage, args=(parse_queue, persist_queue, persist_threads, checkpoint), name='YahooDataParser')
+    persisters = [Thread(target=persist_stage, args=(persist_queue, checkpoint), name=f'YahooDataPersister-{i}') for i in range(persist_threads)]
+    parser.start()
+    for persister in persisters:
+        persister.start()
+
+    start = time.perf_counter()
+    try:
+        fetch_stage(plan, parse_queue, checkpoint)
+    finally:
+        parser.join()
+        for persister in persisters:
+            persister.join()
+    if checkpoint:
+        checkpoint.finish()
+    logger.info("Backfill finished in %.1f s", time.perf_counter() - start)
 
-backfill_data()
\ No newline at end of file
+if __name__ == '__main__':
+    configure_logging()
+    backfill_data()
+    export_metrics(summary=True)
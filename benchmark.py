@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import types
+import random
+import zlib
+import argparse
+import resource
+import subprocess
+from datetime import date, datetime, timedelta
+from threading import Thread, Event
+from typing import Dict, List, Optional, Callable, Any
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import event, select, update, delete, func
+
+from Base import WORKING_DIR, config, configure_logging, get_engine
+
+# Synthetic load benchmark for the ingestion jobs. It runs against its own database (--db-name or --db-url)
+# and replaces finnhub.Client and yahoo_fin get_data with stubs serving a generated universe
+# with a configurable latency, so runs on different commits can be compared from their JSON results
+
+RESULTS_DIR = WORKING_DIR+os.sep+'stage'+os.sep+'bench'
+US_MICS = ['XNAS', 'XNYS', 'ARCX', 'BATS', 'XASE', 'IEXG', 'OOTC']
+
+class LoadStats:
+    # Counts DB round trips and samples RSS while a job runs
+    round_trips: int
+    peak_rss: int
+    _stop: Event
+    _sampler: Optional[Thread]
+
+    def __init__(self):
+        self.round_trips = 0
+        self.peak_rss = 0
+        self._stop = Event()
+        self._sampler = None
+        event.listen(get_engine(), "before_cursor_execute", self._count)
+
+    def _count(self, *args) -> None:
+        self.round_trips += 1
+
+    @staticmethod
+    def rss() -> int:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self) -> None:
+        while not self._stop.wait(0.05):
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+    def start(self) -> None:
+        self.round_trips = 0
+        self.peak_rss = self.rss()
+        self._stop.clear()
+        self._sampler = Thread(target=self._sample, name='RssSampler', daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.peak_rss = max(self.peak_rss, self.rss())
+
+class SyntheticUniverse:
+    # error_rate is the share of quote requests failing with a FinnhubRequestException, which makes the
+    # wrapper replace its client; a request on a client closed by another thread fails the run
+    symbols: List[Dict[str, Any]]
+    years: int
+    latency: float
+    error_rate: float
+    _errors: random.Random
+
+    def __init__(self, n_symbols: int, years: int, latency: float, seed: int = 42, error_rate: float = 0.0):
+        rng = random.Random(seed)
+        self.years = years
+        self.latency = latency
+        self.error_rate = error_rate
+        self._errors = random.Random(seed)
+        self.symbols = []
+        for i in range(n_symbols):
+            ticker = f"S{i:05d}"
+            self.symbols.append({
+                'currency': 'USD',
+                'description': f"SYNTHETIC COMPANY {i}",
+                'displaySymbol': ticker,
+                'figi': f"BBG{i:09d}",
+                'isin': f"US{i:09d}0" if rng.random() < 0.8 else None,
+                'mic': US_MICS[i % len(US_MICS)],
+                'shareClassFIGI': f"BBG{i // 2:09d}S",
+                'symbol': ticker,
+                'symbol2': '',
+                'type': 'Common Stock',
+            })
+
+    def write_mic_csv(self, path: str, n_mics: int) -> str:
+        columns = ['MIC', 'OPERATING MIC', 'OPRT/SGMT', 'MARKET NAME-INSTITUTION DESCRIPTION', 'LEGAL ENTITY NAME', 'LEI',
+                   'MARKET CATEGORY CODE', 'ACRONYM', 'ISO COUNTRY CODE (ISO 3166)', 'CITY', 'WEBSITE', 'STATUS',
+                   'CREATION DATE', 'LAST UPDATE DATE', 'LAST VALIDATION DATE', 'EXPIRY DATE', 'COMMENTS']
+        mics = US_MICS + [f"X{i:03d}" for i in range(max(0, n_mics - len(US_MICS)))]
+        # Every other row leaves LAST UPDATE DATE blank, so the column reads as float like the real file
+        rows = [[mic, mic, 'OPRT', f"SYNTHETIC MARKET {mic}", None, None, 'NSPD', mic, 'US', 'NEW YORK', None, 'ACTIVE',
+                 20050627, 20200101 if i % 2 else None, None, None, None] for i, mic in enumerate(mics)]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pd.DataFrame(rows, columns=columns).to_csv(path, index=False, encoding='latin-1')
+        return path
+
+    def daily_bars(self, ticker: str, start_date: Optional[str] = None) -> pd.DataFrame:
+        end = pd.Timestamp(date.today())
+        start = pd.Timestamp(start_date) if start_date else end - pd.DateOffset(years=self.years)
+        dates = pd.bdate_range(start, end)
+        rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+        close = 50 * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates))))
+        return pd.DataFrame({
+            'date': dates,
+            'open': close * (1 + rng.normal(0, 0.005, len(dates))),
+            'high': close * 1.01,
+            'low': close * 0.99,
+            'close': close,
+            'adjclose': close,
+            'volume': rng.integers(1000, 1000000, len(dates)).astype(float),
+            'ticker': ticker,
+        })
+
+    def finnhub_client(self) -> type:
+        import finnhub
+        universe = self
+
+        class StubFinnhubClient:
+            API_URL = "https://stub.finnhub.invalid/api/v1"
+
+            def __init__(self, api_key: Optional[str] = None):
+                self._session = types.SimpleNamespace(hooks={'response': []})
+                self._closed = False
+
+            def _call(self) -> None:
+                if self._closed:
+                    raise RuntimeError("Request on a closed finnhub client")
+                if universe.latency > 0:
+                    time.sleep(universe.latency)
+
+            def stock_symbols(self, exchange: str) -> List[Dict[str, Any]]:
+                self._call()
+                return [dict(symbol) for symbol in universe.symbols]
+
+            def market_status(self, exchange: str) -> Dict[str, Any]:
+                self._call()
+                return {'exchange': exchange, 'holiday': None, 'isOpen': False, 'session': None, 'timezone': 'America/New_York', 't': int(time.time())}
+
+            def quote(self, symbol: str) -> Dict[str, Any]:
+                self._call()
+                if universe.error_rate > 0 and universe._errors.random() < universe.error_rate:
+                    raise finnhub.FinnhubRequestException(f"Synthetic error for {symbol}")
+                price = 10 + (zlib.crc32(symbol.encode()) % 10000) / 100
+                quote_time = datetime.combine(date.today() - timedelta(days=1), datetime.min.time()) + timedelta(hours=16)
+                return {'c': price, 'd': 0.1, 'dp': 0.5, 'h': price*1.01, 'l': price*0.99, 'o': price, 'pc': price-0.1, 't': int(quote_time.timestamp())}
+
+            def close(self) -> None:
+                self._closed = True
+
+        return StubFinnhubClient
+
+    def get_data(self, ticker: str, start_date: Optional[str] = None, end_date: Optional[str] = None, index_as_date: bool = True, interval: str = "1d") -> pd.DataFrame:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self.daily_bars(ticker, start_date)
+
+def install_stubs(universe: SyntheticUniverse) -> None:
+    # yahoo_fin is only needed for its get_data, which is replaced anyway
+    if 'yahoo_fin.stock_info' not in sys.modules:
+        try:
+            import yahoo_fin.stock_info
+        except ImportError:
+            stock_info = types.ModuleType('yahoo_fin.stock_info')
+            stock_info.get_data = universe.get_data
+            sys.modules['yahoo_fin'] = types.ModuleType('yahoo_fin')
+            sys.modules['yahoo_fin.stock_info'] = stock_info
+
+    import finnhub
+    import FinnHubData
+    import YahooData
+    from RateLimiter import TokenBucket
+    from ResponseCache import response_cache
+    finnhub.Client = universe.finnhub_client()
+    # Every run has to hit the stubs, a warm response cache would hide the work being measured
+    response_cache.enabled = False
+    FinnHubData.finnhub_bucket = TokenBucket('bench_finnhub', 1e9, 1e9)
+    YahooData.get_data = universe.get_data
+    YahooData.yahoo_bucket = TokenBucket('bench_yahoo', 1e9, 1e9)
+
+def reset_database() -> None:
+    import migrate
+    from FinnHubClasses import Exchange, StockSymbol, FinnHubQuote, YahooQuote, JobRun, JobRunItem
+    migrate.migrate()
+    with get_engine().begin() as conn:
+        for table in (JobRunItem.__table__, JobRun.__table__, YahooQuote.__table__, FinnHubQuote.__table__, StockSymbol.__table__, Exchange.__table__):
+            conn.execute(delete(table))
+    for type_ in (Exchange, StockSymbol):
+        type_.invalidate_cache()
+
+def count_rows(table) -> int:
+    with get_engine().connect() as conn:
+        return conn.scalar(select(func.count()).select_from(table))
+
+def limit_yahoo_backfill(n_symbols: int) -> None:
+    # Only the first n symbols need a backfill, the rest look up to date
+    from FinnHubClasses import StockSymbol
+    table = StockSymbol.__table__
+    with get_engine().begin() as conn:
+        keep = [row[0] for row in conn.execute(select(table.c.id).order_by(table.c.id).limit(n_symbols))]
+        conn.execute(update(table).where(table.c.id.not_in(keep)).values(last_yahoo_quote_check=date.today()))
+
+def run_job(stats: LoadStats, name: str, table, fn: Callable[[], None]) -> Dict[str, float]:
+    rows_before = count_rows(table)
+    stats.start()
+    start = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - start
+    stats.stop()
+    rows = count_rows(table) - rows_before
+    result = {
+        'wall_seconds': round(wall, 3),
+        'rows': rows,
+        'rows_per_sec': round(rows / wall, 1) if wall > 0 else 0.0,
+        'db_round_trips': stats.round_trips,
+        'peak_rss_mb': round(stats.peak_rss / 2**20, 1),
+    }
+    print(f"{name:16} {result['wall_seconds']:9.2f} s {rows:10d} rows {result['rows_per_sec']:11.1f} rows/s "
+          f"{result['db_round_trips']:8d} round trips {result['peak_rss_mb']:8.1f} MB")
+    return result
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=WORKING_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: Dict[str, Any], baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline.get('commit')} ({baseline_path}):")
+    for name, result in results['jobs'].items():
+        old = baseline.get('jobs', {}).get(name)
+        if old and old['wall_seconds'] > 0:
+            print(f"{name:16} {result['wall_seconds']/old['wall_seconds']:6.2f}x wall time, "
+                  f"{result['db_round_trips'] - old['db_round_trips']:+d} round trips")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Synthetic load benchmark for the ingestion jobs")
+    parser.add_argument('--db-name', default='FinnHubBench', help="Scratch database, all its market data is deleted")
+    parser.add_argument('--db-url', default=None, help="Scratch database URL, e.g. sqlite:///stage/bench.db, used instead of --db-name")
+    parser.add_argument('--symbols', type=int, default=30000)
+    parser.add_argument('--years', type=int, default=25)
+    parser.add_argument('--mics', type=int, default=2600)
+    parser.add_argument('--yahoo-symbols', type=int, default=200, help="Symbols given a full history in the Yahoo backfill")
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help="Share of quote requests failing, each costs the wrapper's 1 s retry wait")
+    parser.add_argument('--jobs', default='mic_import,symbol_sync,quote_sweep,yahoo_backfill',
+                        help="Comma separated, quote_sweep_async runs the asyncio sweep instead of quote_sweep")
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--compare', default=None, help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    if args.db_name == config.get("db", "db_name", fallback=None):
+        parser.error("--db-name must not be the configured production database")
+    if args.db_url:
+        if args.db_url == config.get("db", "url", fallback=None):
+            parser.error("--db-url must not be the configured production database")
+        config.set("db", "url", args.db_url)
+    else:
+        config.set("db", "url", "")
+        config.set("db", "db_name", args.db_name)
+    configure_logging()
+
+    universe = SyntheticUniverse(args.symbols, args.years, args.latency_ms / 1000, error_rate=args.error_rate)
+    install_stubs(universe)
+    from FinnHubClasses import Exchange, StockSymbol, FinnHubQuote, YahooQuote
+    from FinnHubData import FinnHubClientWrapper
+    from YahooData import backfill_data
+    from MIC import import_iso10383
+
+    reset_database()
+    stats = LoadStats()
+    mic_path = universe.write_mic_csv(RESULTS_DIR+os.sep+'ISO10383_MIC.csv', args.mics)
+    client = FinnHubClientWrapper()
+
+    def yahoo_backfill() -> None:
+        limit_yahoo_backfill(args.yahoo_symbols)
+        backfill_data()
+
+    jobs = {
+        'mic_import': (Exchange.__table__, lambda: import_iso10383(mic_path)),
+        'symbol_sync': (StockSymbol.__table__, client.update_stock_symbols),
+        'quote_sweep': (FinnHubQuote.__table__, client.update_quotes),
+        'quote_sweep_async': (FinnHubQuote.__table__, client.update_quotes_async),
+        'yahoo_backfill': (YahooQuote.__table__, yahoo_backfill),
+    }
+    results: Dict[str, Any] = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'params': vars(args),
+        'jobs': {},
+    }
+    for name in args.jobs.split(','):
+        table, fn = jobs[name]
+        results['jobs'][name] = run_job(stats, name, table, fn)
+
+    output = args.output or RESULTS_DIR+os.sep+f"bench_{results['commit'] or 'unknown'}_{datetime.now():%Y%m%d_%H%M%S}.json"
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
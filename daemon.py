@@ -0,0 +1,171 @@
+import time
+import signal
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+from typing import Callable, Dict, List, Optional
+
+from Base import config, configure_logging, warm_caches, log_cache_stats, CacheCoherencePoller, export_metrics, start_metrics_server
+from Metrics import metrics
+from FinnHubData import FinnHubClientWrapper, ASYNC_QUOTES
+from YahooData import backfill_data
+from MIC import import_iso10383, download_iso10383, ISO10383_PATH
+
+logger = logging.getLogger('DB')
+
+MAX_CONCURRENT_JOBS: int = config.getint("daemon", "max_concurrent_jobs", fallback=2)
+POLL_INTERVAL: float = 1.0
+
+class Job:
+    # A named task run every `interval` seconds, with at most `concurrency` runs in flight
+    name: str
+    fn: Callable[[], None]
+    interval: float
+    concurrency: int
+    next_run: float
+    running: int
+    runs: int
+    failures: int
+    last_duration: Optional[float]
+    total_duration: float
+
+    def __init__(self, name: str, fn: Callable[[], None], interval: float, concurrency: int = 1, start_delay: float = 0):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.concurrency = concurrency
+        self.next_run = time.monotonic() + start_delay
+        self.running = 0
+        self.runs = 0
+        self.failures = 0
+        self.last_duration = None
+        self.total_duration = 0.0
+
+    @classmethod
+    def from_config(cls, name: str, fn: Callable[[], None], default_interval: float) -> Optional["Job"]:
+        # [daemon] <name>_enabled, <name>_interval, <name>_concurrency and <name>_start_delay
+        if not config.getboolean("daemon", name+"_enabled", fallback=True):
+            logger.info(f"Job {name} is disabled")
+            return None
+        return cls(name, fn,
+                   config.getfloat("daemon", name+"_interval", fallback=default_interval),
+                   config.getint("daemon", name+"_concurrency", fallback=1),
+                   config.getfloat("daemon", name+"_start_delay", fallback=0))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'running': self.running,
+            'last_duration': self.last_duration if self.last_duration is not None else 0.0,
+            'avg_duration': self.total_duration / self.runs if self.runs else 0.0,
+        }
+
+class JobScheduler:
+    # Runs due jobs on a shared thread pool of max_concurrent_jobs workers; a job that is still
+    # running `concurrency` times when it comes due again is pushed back a full interval
+    _jobs: List[Job]
+    _pool: ThreadPoolExecutor
+    _lock: Lock
+    _stop: Event
+
+    def __init__(self, jobs: List[Job], max_concurrent_jobs: int = MAX_CONCURRENT_JOBS):
+        self._jobs = jobs
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent_jobs, thread_name_prefix='Job')
+        self._lock = Lock()
+        self._stop = Event()
+
+    def _run(self, job: Job) -> None:
+        start = time.perf_counter()
+        failed = False
+        try:
+            logger.info(f"Job {job.name} started")
+            job.fn()
+        except Exception as ex:
+            failed = True
+            logger.error(f"Job {job.name} failed")
+            logger.error(ex)
+        finally:
+            duration = time.perf_counter() - start
+            metrics.observe('job_seconds', duration, job=job.name)
+            if failed:
+                metrics.inc('job_failures', job=job.name)
+            with self._lock:
+                job.running -= 1
+                job.runs += 1
+                job.failures += 1 if failed else 0
+                job.last_duration = duration
+                job.total_duration += duration
+            logger.info(f"Job {job.name} finished in {duration:.1f} s (runs: {job.runs}, failures: {job.failures}, avg: {job.total_duration/job.runs:.1f} s)")
+
+    def run_pending(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for job in self._jobs:
+                if job.next_run > now:
+                    continue
+                job.next_run = now + job.interval
+                if job.running >= job.concurrency:
+                    logger.warning(f"Job {job.name} is still running, skipping this run")
+                    continue
+                job.running += 1
+                self._pool.submit(self._run, job)
+
+    def run(self) -> None:
+        while not self._stop.is_set():
+            self.run_pending()
+            next_run = min((job.next_run for job in self._jobs), default=time.monotonic() + POLL_INTERVAL)
+            self._stop.wait(max(0.0, min(POLL_INTERVAL, next_run - time.monotonic())))
+        logger.info("Waiting for running jobs to finish")
+        self._pool.shutdown(wait=True)
+
+    def stop(self, *args) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {job.name: job.stats() for job in self._jobs}
+
+def build_jobs(finnhub_client: FinnHubClientWrapper) -> List[Job]:
+    def symbol_sync() -> None:
+        finnhub_client.update_stock_symbols()
+
+    def quote_sweep() -> None:
+        finnhub_client.refresh_market_status()
+        if ASYNC_QUOTES:
+            finnhub_client.update_quotes_async()
+        else:
+            finnhub_client.update_quotes()
+
+    def mic_import() -> None:
+        if config.getboolean("daemon", "mic_download", fallback=False):
+            download_iso10383()
+        import_iso10383(ISO10383_PATH)
+
+    def report() -> None:
+        log_cache_stats()
+        export_metrics()
+
+    jobs = [
+        Job.from_config('mic_import', mic_import, 7*24*3600),
+        Job.from_config('symbol_sync', symbol_sync, 24*3600),
+        Job.from_config('quote_sweep', quote_sweep, 3600),
+        Job.from_config('yahoo_backfill', backfill_data, 24*3600),
+        Job.from_config('report', report, 900),
+    ]
+    return [job for job in jobs if job is not None]
+
+if __name__ == '__main__':
+    configure_logging()
+    warm_caches()
+    coherence = CacheCoherencePoller().start()
+    metrics_server = start_metrics_server()
+    scheduler = JobScheduler(build_jobs(FinnHubClientWrapper()))
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    scheduler.run()
+    coherence.stop()
+    if metrics_server:
+        metrics_server.stop()
+    logger.info(f"Job stats: {scheduler.stats()}")
+    export_metrics(summary=True)
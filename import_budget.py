@@ -0,0 +1,37 @@
+import sys
+import subprocess
+from typing import Dict, List
+
+# Modules that must import quickly and without touching the database
+MODULES: List[str] = ['Metrics', 'Base', 'FinnHubClasses', 'Reconcile', 'RateLimiter', 'ResponseCache', 'SymbolRegistry', 'Checkpoint', 'FinnHubData', 'FinnHubStream', 'YahooData', 'MIC', 'daemon', 'benchmark']
+DEFAULT_BUDGET_MS: float = 3000
+
+def measure(module: str) -> float:
+    # Cumulative import time in ms from a fresh interpreter, as reported by -X importtime
+    check = f"import {module}, Base; assert Base._engine is None, 'importing {module} created the engine'"
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', check], capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(res.stderr.strip().splitlines()[-1])
+    for line in reversed(res.stderr.splitlines()):
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"No import time reported for {module}")
+
+def main(budget_ms: float = DEFAULT_BUDGET_MS) -> int:
+    results: Dict[str, float] = {}
+    failed = False
+    for module in MODULES:
+        try:
+            results[module] = measure(module)
+        except RuntimeError as ex:
+            print(f"{module:16} FAILED {ex}")
+            failed = True
+            continue
+        over = results[module] > budget_ms
+        failed = failed or over
+        print(f"{module:16} {results[module]:8.1f} ms{'  OVER BUDGET' if over else ''}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET_MS))
@@ -0,0 +1,21 @@
+import logging
+from sqlalchemy import inspect
+
+from Base import Base, configure_logging, get_engine
+import FinnHubClasses
+
+logger = logging.getLogger('DB')
+
+def migrate() -> None:
+    # Creates missing tables, indexes and id_seq; changes to existing tables ship as sql/schema_change_*.sql
+    engine = get_engine()
+    existing = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine)
+    created = [table for table in Base.metadata.sorted_tables if table.name not in existing]
+    for table in created:
+        logger.info(f"Created table {table.name}")
+    logger.info(f"Schema up to date, {len(created)} tables created")
+
+if __name__ == '__main__':
+    configure_logging()
+    migrate()
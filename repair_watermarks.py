@@ -0,0 +1,6 @@
+from Base import configure_logging
+from FinnHubClasses import StockSymbol
+
+if __name__ == '__main__':
+    configure_logging()
+    StockSymbol.repair_yahoo_watermarks()
@@ -0,0 +1,13 @@
+ALTER TABLE Symbol
+MODIFY COLUMN `last_yahoo_quote_check` date DEFAULT NULL;
+
+CREATE INDEX `ix_Symbol_last_yahoo_quote_check` ON Symbol(`last_yahoo_quote_check`);
+
+UPDATE Symbol s 
+INNER JOIN (
+    SELECT symbol_key,max(quote_date) as last_quote
+    FROM YahooQuote GROUP BY symbol_key
+) latest_yahoo_quote on s.id = latest_yahoo_quote.symbol_key
+set s.last_yahoo_quote_check=latest_yahoo_quote.last_quote;
+
+commit;
@@ -0,0 +1,5 @@
+CREATE INDEX `ix_Symbol_figi` ON Symbol(`figi`);
+CREATE INDEX `ix_Symbol_isin` ON Symbol(`isin`);
+CREATE INDEX `ix_Symbol_share_class_figi` ON Symbol(`share_class_figi`);
+
+commit;
@@ -0,0 +1,4 @@
+CREATE INDEX `ix_Symbol_update_stamp` ON Symbol(`update_stamp`);
+CREATE INDEX `ix_Exchange_update_stamp` ON Exchange(`update_stamp`);
+
+commit;
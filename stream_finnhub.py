@@ -0,0 +1,8 @@
+import asyncio
+from Base import configure_logging
+from FinnHubStream import TradeStreamIngestor, STREAM_SYMBOLS
+
+if __name__ == '__main__':
+    configure_logging()
+    ingestor: TradeStreamIngestor = TradeStreamIngestor.for_tickers(STREAM_SYMBOLS)
+    asyncio.run(ingestor.run())
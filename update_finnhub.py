@@ -1,5 +1,18 @@
-from FinnHubData import FinnHubClientWrapper
+from Base import configure_logging, warm_caches, CacheCoherencePoller, export_metrics, start_metrics_server
+from FinnHubClasses import Exchange
+from FinnHubData import FinnHubClientWrapper, ASYNC_QUOTES
 
-finnhub_client: FinnHubClientWrapper = FinnHubClientWrapper()
-finnhub_client.update_stock_symbols()
-finnhub_client.update_quotes()
\ No newline at end of file
+if __name__ == '__main__':
+    configure_logging()
+    # Symbol reconciliation reads the table directly and the quote sweep uses the symbol registry; only
+    # exchanges are looked up through the object cache
+    warm_caches(types=[Exchange])
+    coherence = CacheCoherencePoller().start()
+    start_metrics_server()
+    finnhub_client: FinnHubClientWrapper = FinnHubClientWrapper()
+    finnhub_client.update_stock_symbols()
+    if ASYNC_QUOTES:
+        finnhub_client.update_quotes_async()
+    else:
+        finnhub_client.update_quotes()
+    export_metrics(summary=True)